@@ -0,0 +1,187 @@
+import pickle
+import numpy as np
+
+from dataset import summary_metrics
+from sampling import make_contexts, sample_unit, scale_unit
+
+
+ACQUISITIONS = ["uncertainty", "boundary", "both"]
+
+
+## Surrogate
+
+class Surrogate:
+    """Gaussian processes of the mean total reward and flip probability of contexts.
+
+    The inputs are the logs of the values of symbols. Needs scikit-learn, the fitted
+    surrogate is pickled with `save` and predicts without simulating anything.
+    """
+
+    def __init__(self, symbols):
+        self.symbols = list(symbols)
+        self.reward_model = None
+        self.flip_model = None
+        self.flip_constant = None
+
+    def features(self, contexts):
+        return np.log([[context.value(sym) for sym in self.symbols] for context in contexts])
+
+    def fit(self, X, rewards, flipped):
+        """Fit to (N, len(symbols)) log values, mean total rewards and 0/1 flips."""
+        from sklearn.gaussian_process import GaussianProcessClassifier, GaussianProcessRegressor
+        from sklearn.gaussian_process.kernels import RBF, ConstantKernel, WhiteKernel
+
+        nb_dims = X.shape[1]
+        kernel = ConstantKernel() * RBF(length_scale=np.ones(nb_dims), length_scale_bounds=(1e-2, 1e2)) + WhiteKernel()
+        self.reward_model = GaussianProcessRegressor(kernel, normalize_y=True, n_restarts_optimizer=2)
+        self.reward_model.fit(X, rewards)
+
+        flipped = np.asarray(flipped, dtype=int)
+        if flipped.min() == flipped.max():
+            # the classifier needs both classes
+            self.flip_model, self.flip_constant = None, float(flipped[0])
+        else:
+            kernel = ConstantKernel() * RBF(length_scale=np.ones(nb_dims), length_scale_bounds=(1e-2, 1e2))
+            self.flip_model, self.flip_constant = GaussianProcessClassifier(kernel), None
+            self.flip_model.fit(X, flipped)
+
+        return self
+
+    def predict_features(self, X):
+        """Mean reward, its standard deviation and the flip probability at log values X."""
+        mean, std = self.reward_model.predict(X, return_std=True)
+        if self.flip_model is None:
+            flip = np.full(len(X), self.flip_constant)
+        else:
+            flip = self.flip_model.predict_proba(X)[:, 1]
+        return mean, std, flip
+
+    def predict(self, contexts):
+        return self.predict_features(self.features(contexts))
+
+    def save(self, path):
+        with open(path, "wb") as file:
+            pickle.dump(self, file)
+
+    @staticmethod
+    def load(path):
+        with open(path, "rb") as file:
+            return pickle.load(file)
+
+
+## Active learning
+
+class ActiveLearner:
+    """Evaluate the contexts where a surrogate of the transfer is the least certain.
+
+    The first nb_initial contexts are a Sobol sample of the ranges (like those of
+    `sampling.sample_contexts`). Then each round fits the surrogate and evaluates
+    the batch_size contexts of a pool of candidates where the reward is the most
+    uncertain ("uncertainty"), which are the closest to the flip boundary
+    ("boundary"), or both. It stops when the mean standard deviation of the reward
+    over the pool is below target_error, or after max_contexts contexts.
+    """
+
+    def __init__(self, original_context, ranges, base=None, nb_initial=32, batch_size=16, max_contexts=512,
+                 target_error=100, acquisition="both", nb_candidates=4096, seed=0):
+        if acquisition not in ACQUISITIONS:
+            raise ValueError(f"unknown acquisition '{acquisition}', expected one of {ACQUISITIONS}")
+
+        self.original_context = original_context
+        self.base = base
+        self.nb_initial = nb_initial
+        self.batch_size = batch_size
+        self.max_contexts = max_contexts
+        self.target_error = target_error
+        self.acquisition = acquisition
+        self.seed = seed
+
+        # only the symbols of a range are learned, the others are pinned
+        self.fixed = {sym: r[0] for sym, r in ranges.items() if r[0] == r[1]}
+        self.symbols = [sym for sym in ranges if sym not in self.fixed]
+        originals = np.array([original_context.value(sym) for sym in self.symbols])
+        self.lows = originals * np.array([ranges[sym][0] for sym in self.symbols])
+        self.highs = originals * np.array([ranges[sym][1] for sym in self.symbols])
+
+        nb_dims = len(self.symbols)
+        self.initial = scale_unit(sample_unit(nb_initial, nb_dims, "sobol", seed=seed), self.lows, self.highs)
+        self.candidates = scale_unit(sample_unit(nb_candidates, nb_dims, "sobol", seed=seed + 1), self.lows, self.highs)
+
+        self.surrogate = Surrogate(self.symbols)
+        self.X, self.rewards, self.flipped = [], [], []
+        self.history = []
+
+    def contexts(self, values):
+        symbols = self.symbols + list(self.fixed)
+        fixed = np.array([self.original_context.value(sym) * factor for sym, factor in self.fixed.items()])
+        values = np.hstack([values, np.tile(fixed, (len(values), 1))])
+        return make_contexts(self.original_context, symbols, values, self.base)
+
+    def scores(self, mean, std, flip):
+        uncertainty = std / std.max() if std.max() > 0 else std
+        boundary = 4 * flip * (1 - flip)
+        if self.acquisition == "uncertainty":
+            return uncertainty
+        if self.acquisition == "boundary":
+            return boundary
+        return uncertainty + boundary
+
+    def next_batch(self):
+        """Values of the next contexts to evaluate, removed from the candidates."""
+        X = np.log(self.candidates)
+        scores = self.scores(*self.surrogate.predict_features(X))
+
+        # spread the batch, two contexts of a batch are not closer than radius
+        unit = (X - np.log(self.lows)) / (np.log(self.highs) - np.log(self.lows))
+        radius = 0.5 / self.batch_size ** (1 / unit.shape[1])
+        chosen = []
+        for i in np.argsort(-scores):
+            if all(np.linalg.norm(unit[i] - unit[j]) > radius for j in chosen):
+                chosen.append(i)
+            if len(chosen) == self.batch_size:
+                break
+
+        batch = self.candidates[chosen]
+        self.candidates = np.delete(self.candidates, chosen, axis=0)
+        return batch
+
+    def record(self, data):
+        # (context, xml, b1, b2, b3, observations, actions, rewards, infos)
+        metrics = summary_metrics(data[5], data[7], data[8])
+        self.X.append(self.surrogate.features([data[0]])[0])
+        self.rewards.append(metrics["mean_total_reward"])
+        self.flipped.append(metrics["is_flipped"])
+
+    def run(self, scheduler, known=()):
+        """Evaluate contexts with the scheduler until the surrogate is good enough.
+
+        Yields the `(index, data)` results as they are evaluated, the rounds are in
+        `history` as (number of contexts, error). Results whose index is in known,
+        the rows already in the sweep, or was yielded before (contexts whose names
+        round to the same) are dropped, so the surrogate is only fitted on contexts
+        which have their own row.
+        """
+        known = set(known)
+        batch = self.initial
+
+        with scheduler:
+            while True:
+                for index, data in scheduler.map(self.contexts(batch)):
+                    if index in known:
+                        print(f"warning: skipped {index}, the sweep already has a row of that name")
+                        continue
+                    known.add(index)
+                    self.record(data)
+                    yield index, data
+
+                self.surrogate.fit(np.array(self.X), np.array(self.rewards), np.array(self.flipped))
+                _, std, _ = self.surrogate.predict_features(np.log(self.candidates))
+                error = std.mean()
+                self.history.append((len(self.X), error))
+                print(f"active learning: {len(self.X)} contexts, reward error {error:.1f}")
+
+                remaining = min(self.batch_size, self.max_contexts - len(self.X), len(self.candidates))
+                if error < self.target_error or remaining <= 0:
+                    break
+
+                batch = self.next_batch()[:remaining]
@@ -0,0 +1,200 @@
+import numpy as np
+
+
+## Batch layout of contexts
+
+def values_matrix(contexts) -> np.ndarray:
+    """Stack the values of contexts sharing the same symbols into a (N, nb_symbols) array.
+
+    An array is returned as is, so a context grid of shape (..., nb_symbols) can
+    be given directly to all the batch functions of this module.
+    """
+    if isinstance(contexts, np.ndarray):
+        return contexts
+
+    return np.stack([context.values for context in contexts])
+
+
+def exponents_matrix(dimensions, base_dimensions) -> np.ndarray:
+    """Exponents E such that dimensions[i] = prod_j base_dimensions[j] ** E[i, j]."""
+    D = np.array([dim.powers for dim in dimensions], dtype=float)
+    B = np.array([dim.powers for dim in base_dimensions], dtype=float)
+
+    return np.linalg.solve(B.T, D.T).T
+
+
+def base_values(values, reference, base) -> np.ndarray:
+    idx = [reference.symbols.index(sym) for sym in base]
+    return values[..., idx]
+
+
+def scales_matrix(values, reference, dims, base) -> np.ndarray:
+    """Scale of each dimension in dims for every context, shape (..., len(dims)).
+
+    Dividing a dimensional quantity by its scale adimensionalizes it with respect to
+    base, like the `to_adim` transform given by `context.make_transforms(dims, base)`.
+    """
+    base_dims = [reference.dimensions[reference.symbols.index(sym)] for sym in base]
+    E = exponents_matrix(dims, base_dims)
+    b = base_values(values, reference, base)
+
+    return np.prod(b[..., None, :] ** E, axis=-1)
+
+
+## Context metrics
+
+def adimensional_values(contexts, reference, base) -> np.ndarray:
+    values = values_matrix(contexts)
+    return values / scales_matrix(values, reference, reference.dimensions, base)
+
+
+def adimensional_distances(contexts, reference, base) -> np.ndarray:
+    """Batch version of `context.adimensional_distance(reference, base)`."""
+    adim = adimensional_values(contexts, reference, base)
+    reference_adim = adimensional_values(reference.values[None], reference, base)[0]
+
+    return np.linalg.norm(adim - reference_adim, axis=-1)
+
+
+def euclidian_distances(contexts, reference) -> np.ndarray:
+    """Batch version of `context.euclidian_distance(reference)`."""
+    values = values_matrix(contexts)
+    return np.linalg.norm(values - reference.values, axis=-1)
+
+
+def cosine_similarities(contexts, reference) -> np.ndarray:
+    """Batch version of `context.cosine_similarity(reference)`."""
+    values = values_matrix(contexts)
+    norms = np.linalg.norm(values, axis=-1) * np.linalg.norm(reference.values)
+
+    return (values @ reference.values) / norms
+
+
+## Observation transforms
+
+def transform_scales(contexts, dims, base, reference=None) -> np.ndarray:
+    """Per context scale vectors of dims, shape (N, len(dims)).
+
+    Row i gives what `contexts[i].make_transforms(dims, base)` divides by to
+    adimensionalize, so it can be used with `to_adim` and `iter_to_adim`.
+    """
+    if reference is None:
+        reference = contexts[0]
+
+    return scales_matrix(values_matrix(contexts), reference, dims, base)
+
+
+def to_adim(data, scales, out=None) -> np.ndarray:
+    """Adimensionalize stacked data of shape (N, ..., len(dims)) with (N, len(dims)) scales.
+
+    Give `out=data` to transform in place and avoid any copy.
+    """
+    scales = np.asarray(scales)
+    scales = scales.reshape(scales.shape[:1] + (1,) * (data.ndim - 2) + scales.shape[1:])
+
+    return np.divide(data, scales, out=out)
+
+
+def iter_to_adim(data, scales, chunk_size=64, dtype=np.float64):
+    """Adimensionalize the data of many contexts, chunk_size contexts at a time.
+
+    data is either an array (or memmap) of shape (N, ..., len(dims)) or a sequence
+    of N arrays of the same shape, like a column of the data frames. Yields
+    `(start, stop, adim)` where adim holds the contexts start to stop. The same
+    buffer is reused for every chunk, so copy what must outlive the iteration.
+    """
+    nb_contexts = len(scales)
+    buffer = None
+
+    items = None if isinstance(data, np.ndarray) else iter(data)
+
+    for start in range(0, nb_contexts, chunk_size):
+        stop = min(start + chunk_size, nb_contexts)
+
+        if items is None:
+            chunk = data[start:stop]
+        else:
+            chunk = [np.asarray(next(items)) for _ in range(stop - start)]
+
+        if buffer is None:
+            buffer = np.empty((chunk_size,) + np.shape(chunk[0]), dtype=dtype)
+
+        adim = buffer[:stop - start]
+        for i, item in enumerate(chunk):
+            adim[i] = item
+
+        yield start, stop, to_adim(adim, scales[start:stop], out=adim)
+
+
+if __name__ == "__main__":
+    # Checks the batch metrics against the per context ones of pipoli.
+    import time
+    from pipoli.core import Dimension, Context
+
+    BASE_DIMENSIONS = [
+        M := Dimension([1, 0, 0]),
+        L := Dimension([0, 1, 0]),
+        T := Dimension([0, 0, 1]),
+    ]
+    Unit = Dimension([0, 0, 0])
+
+    base = ["m", "L", "g"]
+    original_context = Context(
+        BASE_DIMENSIONS,
+        *zip(
+            ("dt", T, 0.01),
+            ("m", M, 14),
+            ("g", L/T**2, 9.81),
+            ("taumax", M*L**2/T**2, 1),
+            ("L", L, 0.5),
+            ("k0", M*L**2/T**2, 240),
+            ("b0", M*L**2/T, 6),
+            ("armature", M*L**2, 0.1),
+            ("ctrl_cost_weight", T**4/M**2/L**4, 0.1),
+        )
+    )
+
+    rng = np.random.default_rng(0)
+    contexts = [
+        original_context.scale_to(base, original_context.values[[1, 4, 2]] * rng.uniform(.1, 10, 3)).change(taumax=f)
+        for f in rng.uniform(.5, 2, 1000)
+    ]
+
+    start = time.perf_counter()
+    scalar = np.array([
+        (c.adimensional_distance(original_context, base), c.euclidian_distance(original_context), c.cosine_similarity(original_context))
+        for c in contexts
+    ])
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    values = values_matrix(contexts)
+    batch = np.stack([
+        adimensional_distances(values, original_context, base),
+        euclidian_distances(values, original_context),
+        cosine_similarities(values, original_context),
+    ], axis=-1)
+    batch_time = time.perf_counter() - start
+
+    print(f"scalar: {scalar_time:.3f} s, batch: {batch_time:.5f} s")
+    print("max relative difference", np.max(np.abs(batch - scalar) / np.maximum(np.abs(scalar), 1e-300)))
+    assert np.allclose(batch, scalar, rtol=1e-12, atol=1e-12)
+
+    # Checks the batch observation transforms against make_transforms.
+    obs_dims = [L] + [Unit] * 7 + [L/T] * 2 + [1/T] * 7
+    observations = rng.normal(size=(len(contexts), 10, 100, 17))
+
+    start = time.perf_counter()
+    scalar = np.stack([c.make_transforms(obs_dims, base)[0](obs) for c, obs in zip(contexts, observations)])
+    scalar_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scales = transform_scales(contexts, obs_dims, base)
+    batch = np.empty_like(observations)
+    for i, j, adim in iter_to_adim(observations, scales, chunk_size=100):
+        batch[i:j] = adim
+    batch_time = time.perf_counter() - start
+
+    print(f"scalar transforms: {scalar_time:.3f} s, batch transforms: {batch_time:.3f} s")
+    assert np.allclose(batch, scalar, rtol=1e-12, atol=0)
+    assert np.allclose(to_adim(observations, scales, out=observations), scalar, rtol=1e-12, atol=0)
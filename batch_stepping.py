@@ -0,0 +1,138 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+import numpy as np
+
+from mjx_backend import FRAME_SKIP, INFO_KEYS, RESET_NOISE_SCALE, compile_models, info_dicts
+
+
+## Stepping engine
+
+class SteppingEngine:
+    """Many MuJoCo instances of HalfCheetah-v5 stepped together by a pool of threads.
+
+    There is one instance (an MjData of the model of its context) per context and
+    episode. At each step the actions of all the instances are given at once, then
+    each thread steps its share of the instances with `mj_step`, which releases the
+    GIL, and writes their state into contiguous (nb_instances, ...) arrays. A single
+    process then uses all the cores for the physics, with one model per context.
+    """
+
+    def __init__(self, contexts, nb_episodes=1, threads=None, frame_skip=FRAME_SKIP, reset_noise_scale=RESET_NOISE_SCALE):
+        import mujoco
+
+        models = compile_models(contexts)
+        # instances are context major, the episodes of a context are contiguous
+        self.models = [model for model in models for _ in range(nb_episodes)]
+        self.datas = [mujoco.MjData(model) for model in self.models]
+        self.nb_instances = len(self.datas)
+        self.frame_skip = frame_skip
+        self.reset_noise_scale = reset_noise_scale
+
+        self.init_qpos = np.array([model.qpos0 for model in self.models])
+        self.dt = np.array([model.opt.timestep * frame_skip for model in self.models])
+        self.forward_weight = np.repeat([context.value("forward_reward_weight") for context in contexts], nb_episodes)
+        self.ctrl_weight = np.repeat([context.value("ctrl_cost_weight") for context in contexts], nb_episodes)
+
+        self.qpos = np.zeros_like(self.init_qpos)
+        self.qvel = np.zeros((self.nb_instances, models[0].nv))
+
+        self.threads = threads or len(os.sched_getaffinity(0))
+        self.chunks = np.array_split(np.arange(self.nb_instances), self.threads)
+        self.executor = ThreadPoolExecutor(self.threads)
+
+    def _run(self, task):
+        for future in [self.executor.submit(task, chunk) for chunk in self.chunks if len(chunk)]:
+            future.result()
+
+    def observation(self):
+        return np.concatenate([self.qpos[:, 1:], self.qvel], axis=1)
+
+    def set_state(self, qpos, qvel):
+        import mujoco
+
+        def task(chunk):
+            for i in chunk:
+                model, data = self.models[i], self.datas[i]
+                mujoco.mj_resetData(model, data)
+                data.qpos[:], data.qvel[:] = qpos[i], qvel[i]
+                mujoco.mj_forward(model, data)
+                self.qpos[i], self.qvel[i] = data.qpos, data.qvel
+
+        self._run(task)
+        return self.observation()
+
+    def reset(self, rngs):
+        """Reset all the instances with the noise of the gym env, returns the observations.
+
+        rngs are the random generators of the contexts, each draws the noise of its episodes.
+        """
+        noise = self.reset_noise_scale
+        nb_episodes = self.nb_instances // len(rngs)
+        qpos = self.init_qpos + np.concatenate([
+            rng.uniform(-noise, noise, (nb_episodes, self.init_qpos.shape[1])) for rng in rngs
+        ])
+        qvel = noise * np.concatenate([rng.standard_normal((nb_episodes, self.qvel.shape[1])) for rng in rngs])
+        return self.set_state(qpos, qvel)
+
+    def step(self, actions):
+        """Step all the instances, returns the observations, rewards and infos arrays."""
+        import mujoco
+
+        actions = np.asarray(actions, dtype=np.float64)
+        x_before = self.qpos[:, 0].copy()
+
+        def task(chunk):
+            for i in chunk:
+                model, data = self.models[i], self.datas[i]
+                data.ctrl[:] = actions[i]
+                mujoco.mj_step(model, data, nstep=self.frame_skip)
+                self.qpos[i], self.qvel[i] = data.qpos, data.qvel
+
+        self._run(task)
+
+        x_after = self.qpos[:, 0]
+        x_velocity = (x_after - x_before) / self.dt
+        reward_forward = self.forward_weight * x_velocity
+        reward_ctrl = -self.ctrl_weight * np.sum(np.square(actions), axis=1)
+        infos = np.stack([x_after, x_velocity, reward_forward, reward_ctrl], axis=1)
+
+        return self.observation(), reward_forward + reward_ctrl, infos
+
+    def close(self):
+        self.executor.shutdown()
+
+
+## Rollouts
+
+def threaded_rollouts(contexts, policy, nb_episodes, nb_steps=1000, seeds=None, threads=None):
+    """Evaluate a batched policy in all the contexts at once, like `mjx_backend.batched_rollouts`.
+
+    All the episodes are simulated at the same time, policy maps the (nb_contexts,
+    nb_episodes, 17) observations to the (nb_contexts, nb_episodes, 6) actions in one
+    call, e.g. `mjx_backend.transferred_policy`. seeds are those of the contexts, so
+    their results don't depend on the other contexts of the batch.
+    """
+    engine = SteppingEngine(contexts, nb_episodes, threads)
+    rngs = [np.random.default_rng(seed) for seed in seeds or [None] * len(contexts)]
+    nb_contexts = len(contexts)
+
+    observations = np.zeros((nb_contexts, nb_episodes, nb_steps, 17))
+    actions = np.zeros((nb_contexts, nb_episodes, nb_steps, 6))
+    rewards = np.zeros((nb_contexts, nb_episodes, nb_steps))
+    infos = np.zeros((nb_contexts, nb_episodes, nb_steps, len(INFO_KEYS)))
+
+    obs = engine.reset(rngs).reshape(nb_contexts, nb_episodes, -1)
+    for step in range(nb_steps):
+        act = policy(obs)
+        observations[:, :, step] = obs
+        actions[:, :, step] = act
+
+        obs, rew, info = engine.step(act.reshape(nb_contexts * nb_episodes, -1))
+        obs = obs.reshape(nb_contexts, nb_episodes, -1)
+        rewards[:, :, step] = rew.reshape(nb_contexts, nb_episodes)
+        infos[:, :, step] = info.reshape(nb_contexts, nb_episodes, -1)
+
+    engine.close()
+
+    infos = info_dicts(infos)
+    return [(observations[i], actions[i], rewards[i], infos[i]) for i in range(nb_contexts)]
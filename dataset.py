@@ -0,0 +1,766 @@
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+import os
+from pathlib import Path
+import pickle
+import re
+import shutil
+import sys
+import zlib
+import numpy as np
+import pandas as pd
+
+
+TRAJECTORY_FIELDS = ["observations", "actions", "rewards", "infos"]
+# observations and actions adimensionalized by their context, recorded after the others if asked
+ADIM_FIELDS = ["adim_observations", "adim_actions"]
+# fixed size summaries of the observations and actions, see sketch.py, stored like the trajectories
+SKETCH_FIELDS = ["observation_sketch", "action_sketch"]
+# every field stored as per context arrays instead of in the table
+STORED_FIELDS = TRAJECTORY_FIELDS + ADIM_FIELDS + SKETCH_FIELDS
+META_FILE = "meta.pkl"
+
+# those of `summary_metrics`, stored in the datasets to filter them without reading the trajectories
+SUMMARY_COLUMNS = [
+    "mean_total_reward", "std_total_reward",
+    "mean_total_reward_forward", "std_total_reward_forward",
+    "mean_total_reward_ctrl", "std_total_reward_ctrl",
+    "is_flipped",
+]
+
+
+## Codecs
+
+CODECS = ["none", "zstd", "lz4", "zlib"]
+
+
+def compress(codec, data, level=None):
+    if codec == "zstd":
+        import zstandard
+        # a compressor can't be shared between threads
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if codec == "lz4":
+        import lz4.frame
+        return lz4.frame.compress(data, compression_level=0 if level is None else level)
+    if codec == "zlib":
+        return zlib.compress(data, 6 if level is None else level)
+    raise ValueError(f"unknown codec '{codec}', expected one of {CODECS}")
+
+
+def decompress(codec, data):
+    if codec == "zstd":
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "lz4":
+        import lz4.frame
+        return lz4.frame.decompress(data)
+    if codec == "zlib":
+        return zlib.decompress(data)
+    raise ValueError(f"unknown codec '{codec}', expected one of {CODECS}")
+
+
+## Lazy access to the trajectories
+
+class Field:
+    """One trajectory column of a dataset.
+
+    Without compression (codec "none"), it's a (nb_contexts, ...) .npy file which is
+    memory-mapped on first access, so only the pages of the contexts that are
+    actually read are loaded in memory. Otherwise, it's a .bin file of the
+    independently compressed arrays of each context, found with the `offsets` table.
+    """
+
+    # fields of the datasets written before compression was supported
+    codec = "none"
+    offsets = None
+
+    def __init__(self, path, shape, dtype, info_keys=None, codec="none", offsets=None):
+        self.path = Path(path)
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.info_keys = info_keys
+        self.codec = codec
+        self.offsets = offsets
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.load(self.path, mmap_mode="r")
+        return self._data
+
+    def read(self, position):
+        """The stored array of a context, infos are left encoded."""
+        if self.codec == "none":
+            return self.data[position]
+
+        offset, size = self.offsets[position]
+        with open(self.path, "rb") as file:
+            file.seek(offset)
+            chunk = file.read(size)
+
+        return np.frombuffer(decompress(self.codec, chunk), dtype=self.dtype).reshape(self.shape)
+
+    def load(self, position):
+        data = self.read(position)
+        if self.info_keys is not None:
+            return decode_infos(data)
+        return data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+
+class LazyArray:
+    """Handle to the trajectory of one context, paged in when accessed or sliced."""
+
+    def __init__(self, field, position):
+        self.field = field
+        self.position = position
+
+    @property
+    def shape(self):
+        return self.field.shape
+
+    @property
+    def ndim(self):
+        return len(self.field.shape)
+
+    @property
+    def dtype(self):
+        return np.dtype(object) if self.field.info_keys is not None else self.field.dtype
+
+    def load(self):
+        return self.field.load(self.position)
+
+    def __getitem__(self, key):
+        if self.field.info_keys is not None:
+            return self.load()[key]
+        return self.field.read(self.position)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.load(), dtype=dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __getattr__(self, name):
+        # reshape, sum, mean, ... are those of the underlying array
+        if name.startswith("__") or name in ("field", "position"):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        return f"LazyArray(shape={self.shape}, dtype={self.dtype}, file='{self.field.path.name}')"
+
+
+## Infos encoding
+
+def info_dtype(info_keys):
+    return np.dtype([(key, np.float64) for key in info_keys])
+
+
+def encode_infos(infos, info_keys, out=None):
+    """Encode an object array of info dicts into a structured array of floats."""
+    infos = np.asarray(infos)
+    if out is None:
+        out = np.full(infos.shape, np.nan, dtype=info_dtype(info_keys))
+
+    for idx, info in np.ndenumerate(infos):
+        if info is not None:
+            out[idx] = tuple(float(info.get(key, np.nan)) for key in info_keys)
+
+    return out
+
+
+def decode_infos(encoded):
+    """Decode a structured array of floats back into an object array of info dicts."""
+    keys = encoded.dtype.names
+    infos = np.full(encoded.shape, None)
+
+    for idx, record in np.ndenumerate(encoded):
+        infos[idx] = dict(zip(keys, record.tolist()))
+
+    return infos
+
+
+def find_info_keys(infos):
+    for info in np.asarray(infos).flat:
+        if info is not None:
+            return list(info.keys())
+    return []
+
+
+def info_values(infos, key):
+    """Array of the info values of key, without decoding the dicts of lazy or encoded infos."""
+    if isinstance(infos, LazyArray) and infos.field.info_keys is not None:
+        return np.asarray(infos.field.read(infos.position)[key])
+    if isinstance(infos, np.ndarray) and infos.dtype.names is not None:
+        return np.asarray(infos[key])
+
+    return np.vectorize(lambda info: info[key], otypes=[np.float64])(infos)
+
+
+## Summary metrics
+
+def summary_metrics(observations, rewards, infos):
+    """Per context metrics of the analysis notebooks, from its trajectories."""
+    totals_forward = info_values(infos, "reward_forward").sum(axis=-1)
+    totals_ctrl = info_values(infos, "reward_ctrl").sum(axis=-1)
+    totals = np.asarray(rewards).sum(axis=-1)
+
+    # flipped when the torso angle goes past 100 degrees during an episode
+    is_flipped = np.abs(np.asarray(observations[..., 1])) > np.pi / 1.8
+
+    return dict(
+        mean_total_reward=totals.mean(),
+        std_total_reward=totals.std(),
+        mean_total_reward_forward=totals_forward.mean(),
+        std_total_reward_forward=totals_forward.std(),
+        mean_total_reward_ctrl=totals_ctrl.mean(),
+        std_total_reward_ctrl=totals_ctrl.std(),
+        is_flipped=int(is_flipped.any()),
+    )
+
+
+## Transfer mode
+
+def transfer_mode(attrs, name=""):
+    """Contexts ('similar' or 'non-similar') and policy ('scaled' or 'naive') of a sweep.
+
+    They're read from the comment the generators record, or from the file name of
+    the sweep when the comment doesn't tell, None if neither does.
+    """
+    comment = attrs.get("comment", "")
+    name = Path(name).name
+
+    if "contexts are not similar" in comment:
+        mode = "non-similar"
+    elif "contexts are similar" in comment:
+        mode = "similar"
+    else:
+        mode = "non-similar" if "non-similar" in name else "similar" if "similar" in name else None
+
+    if "policy was not scaled" in comment:
+        policy = "naive"
+    elif "policy was scaled" in comment:
+        policy = "scaled"
+    else:
+        policy = "naive" if "naive" in name else "scaled" if "similar" in name else None
+
+    return mode, policy
+
+
+## Writing
+
+class DatasetWriter:
+    """Writes a dataset directory context by context.
+
+    `fields` maps each trajectory field to the shape of one context's array; the
+    "infos" field also needs `info_keys`. Without compression, the trajectory files
+    are preallocated for nb_contexts rows, so each context is written at its
+    position independently of the others and never kept in memory. With a codec,
+    the arrays of each context are compressed independently by a pool of threads
+    and appended to the files, at most a few chunks per thread are pending.
+    """
+
+    def __init__(self, path, nb_contexts, fields, info_keys=None, attrs=None, codec="none", level=None, threads=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.nb_contexts = nb_contexts
+        self.attrs = dict(attrs or {})
+        self.info_keys = info_keys
+        self.codec = codec
+        self.level = level
+        self.index = [None] * nb_contexts
+        self.rows = [None] * nb_contexts
+        self.metrics = [None] * nb_contexts
+        self.fields = {}
+        self.buffers = {}
+
+        if codec != "none":
+            compress(codec, b"", level)  # fails early on unknown or missing codecs
+            self.threads = threads or os.cpu_count()
+            self.executor = ThreadPoolExecutor(self.threads)
+            self.pending = deque()
+
+        for name, shape in fields.items():
+            dtype = info_dtype(info_keys) if name == "infos" else np.float64
+            keys = info_keys if name == "infos" else None
+
+            if codec == "none":
+                self.fields[name] = Field(self.path / f"{name}.npy", shape, dtype, keys)
+                self.buffers[name] = np.lib.format.open_memmap(
+                    self.fields[name].path, mode="w+", dtype=dtype, shape=(nb_contexts,) + tuple(shape)
+                )
+            else:
+                offsets = np.zeros((nb_contexts, 2), dtype=np.int64)
+                self.fields[name] = Field(self.path / f"{name}.bin", shape, dtype, keys, codec, offsets)
+                self.buffers[name] = open(self.fields[name].path, "wb")
+
+    def write(self, position, index, row, arrays):
+        """Write the scalar columns (row, a dict) and trajectory arrays of one context.
+
+        The infos are info dicts, or already encoded with the info_keys of the writer.
+        """
+        self.index[position] = index
+        self.rows[position] = row
+        if all(name in arrays for name in ["observations", "rewards", "infos"]):
+            self.write_metrics(position, arrays["observations"], arrays["rewards"], arrays["infos"])
+
+        for name, array in arrays.items():
+            encode = name == "infos" and array.dtype.names is None
+
+            if self.codec == "none":
+                if encode:
+                    encode_infos(array, self.info_keys, out=self.buffers[name][position])
+                else:
+                    self.buffers[name][position] = array
+                continue
+
+            if encode:
+                array = encode_infos(array, self.info_keys)
+            data = np.ascontiguousarray(array, dtype=self.fields[name].dtype).tobytes()
+            self.pending.append((name, position, self.executor.submit(compress, self.codec, data, self.level)))
+
+        if self.codec != "none":
+            while len(self.pending) > 2 * self.threads * len(self.fields):
+                self.append_chunk()
+
+    def write_metrics(self, position, observations, rewards, infos):
+        self.metrics[position] = summary_metrics(observations, rewards, infos)
+
+    def append_chunk(self):
+        name, position, future = self.pending.popleft()
+        chunk = future.result()
+        file = self.buffers[name]
+        self.fields[name].offsets[position] = file.tell(), len(chunk)
+        file.write(chunk)
+
+    def close(self):
+        if self.codec == "none":
+            for buffer in self.buffers.values():
+                buffer.flush()
+        else:
+            while self.pending:
+                self.append_chunk()
+            self.executor.shutdown()
+            for file in self.buffers.values():
+                file.close()
+        self.buffers = {}
+
+        table = pd.DataFrame(self.rows, index=self.index)
+        if any(m is not None for m in self.metrics):
+            metrics = pd.DataFrame([m or {} for m in self.metrics], index=self.index, columns=SUMMARY_COLUMNS)
+        else:
+            # no context had its observations, rewards and infos, e.g. those of the extractors
+            metrics = pd.DataFrame(index=self.index)
+        meta = dict(attrs=self.attrs, table=table, metrics=metrics, fields=self.fields, codec=self.codec, level=self.level)
+        (self.path / META_FILE).write_bytes(pickle.dumps(meta))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.close()
+
+
+def recorded_fields(adimensional=False):
+    """Trajectory fields of the results of `process_context`, in their order."""
+    return TRAJECTORY_FIELDS + (ADIM_FIELDS if adimensional else [])
+
+
+def trajectory_layout(df):
+    """Trajectory fields of a data frame, its other columns, the shapes of the fields and the info keys."""
+    fields = [name for name in STORED_FIELDS if name in df.columns]
+    columns = [c for c in df.columns if c not in fields]
+    first = df.iloc[0]
+
+    shapes = {name: np.shape(first[name]) for name in fields}
+    info_keys = find_info_keys(first["infos"]) if "infos" in fields else None
+
+    return fields, columns, shapes, info_keys
+
+
+def write_dataset(df, path, codec="none", level=None, threads=None):
+    """Write an in-memory data frame of the generators to a dataset directory.
+
+    codec is one of CODECS, the chunks of the contexts are compressed in parallel
+    by threads threads (all the cores by default).
+    """
+    fields, columns, shapes, info_keys = trajectory_layout(df)
+
+    with DatasetWriter(path, len(df), shapes, info_keys, df.attrs, codec, level, threads) as writer:
+        for position, (index, row) in enumerate(df.iterrows()):
+            writer.write(position, index, row[columns].to_dict(), {name: row[name] for name in fields})
+
+    return path
+
+
+## Trajectories written by other processes
+
+class SharedWriter:
+    """Writes the trajectories of contexts into the memory-mapped files of a dataset.
+
+    The dataset is being written by a `DatasetWriter` without compression in another
+    process, which preallocated the files. Worker processes write the arrays of a
+    context at its position, so they are never pickled back to the parent, see
+    `preallocate_dataset`.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.buffers = {}
+
+    def buffer(self, name):
+        if name not in self.buffers:
+            self.buffers[name] = np.load(self.path / f"{name}.npy", mmap_mode="r+")
+        return self.buffers[name]
+
+    def write(self, position, arrays):
+        for name, array in arrays.items():
+            buffer = self.buffer(name)
+            if name == "infos":
+                encode_infos(array, buffer.dtype.names, out=buffer[position])
+            else:
+                buffer[position] = array
+
+
+def preallocate_dataset(df, path, nb_contexts):
+    """Uncompressed `DatasetWriter` of nb_contexts rows like those of df, for a `SharedWriter`.
+
+    Rows whose trajectories are written by the workers get `LazyArray` handles on
+    the files, then `finish_dataset` writes the rest of the rows.
+    """
+    _, _, shapes, info_keys = trajectory_layout(df)
+    return DatasetWriter(path, nb_contexts, shapes, info_keys, df.attrs)
+
+
+def finish_dataset(writer, df, path):
+    """Write the rows of df to a preallocated dataset, then move it to path.
+
+    The rows with `LazyArray` handles are at the position of their handles, their
+    trajectories are already written, the others are at their position in df.
+    """
+    fields, columns, _, _ = trajectory_layout(df)
+    writer.attrs = dict(df.attrs)
+
+    for position, (index, row) in enumerate(df.iterrows()):
+        arrays = {name: row[name] for name in fields if not isinstance(row[name], LazyArray)}
+        if len(arrays) < len(fields):
+            position = row[fields[0]].position
+        writer.write(position, index, row[columns].to_dict(), arrays)
+        if len(arrays) < len(fields):
+            writer.write_metrics(position, row["observations"], row["rewards"], row["infos"])
+    writer.close()
+
+    path = Path(path)
+    if path.exists():
+        shutil.rmtree(path)
+    writer.path.rename(path)
+
+    return path
+
+
+## Streaming pickled data frames
+
+class SpilledArray(np.ndarray):
+    """Array of a pickled data frame, its trajectory is moved to a spill file while unpickling.
+
+    The unpickler creates the arrays empty and fills them with their state. Those of
+    the data frame itself and the small ones of the cells are filled as usual, the
+    trajectories (arrays of the cells with 2 dimensions or more) are written to the
+    spill file and stay empty, `load` reads them back.
+    """
+
+    offset = None
+
+    def __setstate__(self, state):
+        # state of ndarray.__reduce__: (version, shape, dtype, is_fortran, data)
+        _, shape, dtype, is_fortran, data = state
+        unpickler, self.unpickler = self.unpickler, None
+        if not self.nested:
+            unpickler.depth -= 1
+        if not self.nested or len(shape) < 2:
+            return super().__setstate__(state)
+
+        order = "F" if is_fortran else "C"
+        if dtype.hasobject:
+            infos = np.empty(len(data), dtype=object)
+            infos[:] = data
+            infos = infos.reshape(shape, order=order)
+            # all the infos are encoded with the keys of the first ones
+            unpickler.info_keys = unpickler.info_keys or find_info_keys(infos)
+            unpickler.spill(self, encode_infos(infos, unpickler.info_keys))
+        else:
+            unpickler.spill(self, np.frombuffer(data, dtype=dtype).reshape(shape, order=order))
+
+    def load(self):
+        """The trajectory, infos are encoded like those of `dataset.encode_infos`."""
+        file = self.spill_file
+        file.seek(self.offset)
+        data = file.read(self.spilled_dtype.itemsize * int(np.prod(self.spilled_shape)))
+        return np.frombuffer(data, dtype=self.spilled_dtype).reshape(self.spilled_shape)
+
+
+class Memo(dict):
+    # the memo of the unpickler, whose entries can be deleted: the index of the next
+    # object memoized is its length, which counts the deleted entries
+    def __init__(self):
+        super().__init__()
+        self.length = 0
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.length = max(self.length, key + 1)
+
+    def __len__(self):
+        return self.length
+
+
+class SpillingUnpickler(pickle._Unpickler):
+    """Unpickles a data frame of the generators without keeping its trajectories in memory.
+
+    The trajectories are numpy arrays inside the object arrays of the frame, each
+    one is written to spill_file as soon as it's unpickled, see `SpilledArray`, and
+    the memo entries of its data are dropped, so the memory stays about that of one
+    context whatever the size of the file. It's the pure Python unpickler, the memo
+    of the C one can't be pruned while loading.
+    """
+
+    def __init__(self, file, spill_file):
+        super().__init__(file)
+        self.memo = Memo()
+        self.spill_file = spill_file
+        self.depth = 0
+        self.scanned = 0
+        self.info_keys = None
+
+    def find_class(self, module, name):
+        if module.startswith("numpy") and name == "_reconstruct":
+            return self.reconstruct
+        if module.startswith("numpy") and name == "_frombuffer":
+            return self.frombuffer
+        return super().find_class(module, name)
+
+    def empty(self):
+        array = np.ndarray.__new__(SpilledArray, (0,), np.uint8)
+        array.unpickler = self
+        array.nested = self.depth > 0
+        array.mark = len(self.memo)
+        return array
+
+    def reconstruct(self, cls, shape, dtype):
+        array = self.empty()
+        if not array.nested:
+            # the cells of this array are nested until its state is set
+            self.depth += 1
+        return array
+
+    def frombuffer(self, buffer, dtype, shape, order):
+        array = np.frombuffer(buffer, dtype=dtype).reshape(shape, order=order)
+        if self.depth == 0 or len(shape) < 2:
+            return array
+        spilled = self.empty()
+        spilled.unpickler = None
+        self.spill(spilled, array)
+        return spilled
+
+    def spill(self, spilled, array):
+        spilled.spill_file = self.spill_file
+        spilled.spilled_shape, spilled.spilled_dtype = array.shape, array.dtype
+        self.spill_file.seek(0, 2)
+        spilled.offset = self.spill_file.tell()
+        self.spill_file.write(np.ascontiguousarray(array).tobytes())
+
+        # the memo keeps everything unpickled, drop the data of the spilled array: the
+        # buffers, and the lists and dicts of its state (info dicts), with the tuples of
+        # its arguments and state
+        memo = self.memo
+        for key in range(self.scanned, len(memo)):
+            if key in memo and is_data(memo[key], key >= spilled.mark):
+                del memo[key]
+        self.scanned = len(memo)
+
+
+def is_data(value, in_state):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value) > 1024
+    if isinstance(value, (list, dict)):
+        return in_state
+    if isinstance(value, tuple):
+        return any(is_data(item, in_state) for item in value)
+    return False
+
+
+def load_spilled(path, spill_file):
+    """Load a pickled data frame, its trajectory cells are `SpilledArray` in spill_file."""
+    path = Path(path)
+    with (gzip.open(path, "rb") if path.suffix == ".gz" else open(path, "rb")) as file:
+        unpickler = SpillingUnpickler(file, spill_file)
+        return unpickler.load()
+
+
+def stored_layout(cell):
+    """Shape and dtype of a trajectory cell as stored, infos are encoded."""
+    if isinstance(cell, LazyArray):
+        return cell.shape, cell.field.dtype
+    if isinstance(cell, SpilledArray):
+        return cell.spilled_shape, cell.spilled_dtype
+    if np.asarray(cell).dtype.hasobject:
+        return np.shape(cell), info_dtype(find_info_keys(cell))
+    return np.shape(cell), np.float64
+
+
+def stored_array(cell):
+    """The array of a trajectory cell as stored, infos are encoded with their keys."""
+    if isinstance(cell, LazyArray):
+        return cell.field.read(cell.position)
+    if isinstance(cell, SpilledArray):
+        return cell.load()
+    if np.asarray(cell).dtype.hasobject:
+        return encode_infos(cell, find_info_keys(cell))
+    return np.asarray(cell)
+
+
+## Reading
+
+def lazy_column(field, positions, index):
+    # filled one by one, otherwise pandas would materialize the handles as arrays
+    column = np.empty(len(positions), dtype=object)
+    for i, position in enumerate(positions):
+        column[i] = LazyArray(field, position)
+
+    return pd.Series(column, index=index)
+
+
+def metrics_frame(df):
+    """Summary metrics of each context of a data frame, computed from its trajectories.
+
+    There are none if the data frame doesn't have its observations, rewards and infos.
+    """
+    if not all(name in df.columns for name in ["observations", "rewards", "infos"]):
+        return pd.DataFrame(index=df.index)
+    metrics = [summary_metrics(row["observations"], row["rewards"], row["infos"]) for _, row in df.iterrows()]
+    return pd.DataFrame(metrics, index=df.index, columns=SUMMARY_COLUMNS)
+
+
+def with_metrics(df, metrics):
+    df = df.copy()
+    for column in metrics.columns:
+        df[column] = metrics[column].to_numpy()
+    return df
+
+
+def select(df, metrics, where):
+    """Positions of the rows of df matching the condition where, see `load_dataset`."""
+    if where is None:
+        return np.arange(len(df))
+    if metrics is not None:
+        df = with_metrics(df, metrics)
+
+    missing = [name for name in SUMMARY_COLUMNS if name not in df.columns and re.search(rf"\b{name}\b", where)]
+    if missing:
+        raise ValueError(
+            f"the condition '{where}' uses {', '.join(missing)}, which the dataset doesn't have, "
+            "its observations, rewards or infos weren't extracted"
+        )
+    return np.flatnonzero(df.eval(where).to_numpy())
+
+
+def is_dataset_dir(path):
+    return (Path(path) / META_FILE).exists()
+
+
+def lazy_frame(table, fields, positions):
+    df = table.iloc[positions].copy()
+    for name, field in fields.items():
+        df[name] = lazy_column(field, positions, df.index)
+    return df
+
+
+def load_dataset(path, where=None, metrics=False):
+    """Load a dataset like `pd.read_pickle`, but lazily for dataset directories.
+
+    The trajectory cells of a dataset directory are `LazyArray` handles over
+    memory-mapped files, or over compressed chunks decompressed on access with the
+    codec of the dataset, the rest of the columns are in memory. Pickled data
+    frames are loaded as usual.
+
+    where only loads the contexts matching a condition like those of
+    `pd.DataFrame.query`, on the index, the columns other than the trajectories and
+    the SUMMARY_COLUMNS, e.g. "index != 'original' and 10 <= b1 <= 20 and is_flipped
+    == 0". The metrics are stored in the dataset directories, so only the
+    trajectories of the matching contexts are ever read. metrics adds the
+    SUMMARY_COLUMNS to the data frame. Datasets without the observations, rewards
+    or infos, like those of the extractors, have no metrics, and a condition on
+    them raises a ValueError.
+    """
+    path = Path(path)
+    if not is_dataset_dir(path):
+        df = pd.read_pickle(path)
+        if where is None and not metrics:
+            return df
+        summary = metrics_frame(df)
+        positions = select(df, summary, where)
+        df, summary = df.iloc[positions], summary.iloc[positions]
+        return with_metrics(df, summary) if metrics else df
+
+    meta = pickle.loads((path / META_FILE).read_bytes())
+    table = meta["table"]
+    for field in meta["fields"].values():
+        # the files are found relative to the dataset, so it can be moved around
+        field.path = path / field.path.name
+
+    summary = meta.get("metrics")
+    if summary is None and (where is not None or metrics):
+        # written before the metrics were stored, they are computed from all the trajectories
+        summary = metrics_frame(lazy_frame(table, meta["fields"], np.arange(len(table))))
+
+    positions = select(table, summary, where)
+    df = lazy_frame(table, meta["fields"], positions)
+    if metrics:
+        df = with_metrics(df, summary.iloc[positions])
+    df.attrs = meta["attrs"]
+
+    return df
+
+
+def dataset_codec(path):
+    """Codec and level of a dataset directory, to write derived datasets the same way."""
+    meta = pickle.loads((Path(path) / META_FILE).read_bytes())
+    return meta.get("codec", "none"), meta.get("level")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert pickled dataframes to lazily loadable dataset directories.")
+    parser.add_argument("infile", nargs=1, type=Path, help="the file containing the dataframe to convert")
+    parser.add_argument("-o", "--outdir", type=Path, help="the dataset directory to create, defaults to the file name with '.ds'")
+    parser.add_argument("-c", "--codec", choices=CODECS, default="none", help="compression of the trajectories, 'none' allows memory mapping them")
+    parser.add_argument("-l", "--level", type=int, default=None, help="compression level of the codec")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="number of compression threads, defaults to the number of cores")
+    args = parser.parse_args()
+
+    file, = args.infile
+
+    if not (file.exists() and file.is_file()):
+        print(f"error: '{file}' is not a file", file=sys.stderr)
+        exit(1)
+
+    outdir = args.outdir or file.parent / (file.name.removesuffix(".gz").removesuffix(".pkl") + ".ds")
+
+    print("loading...")
+    all_data = pd.read_pickle(str(file.absolute()))
+
+    print("writing...")
+    write_dataset(all_data, outdir, args.codec, args.level, args.threads)
+
+    print("done.")
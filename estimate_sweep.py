@@ -0,0 +1,266 @@
+import argparse
+from collections import namedtuple
+import gzip
+import importlib
+import math
+import multiprocessing
+import os
+from pathlib import Path
+import pickle
+import shutil
+import sys
+import time
+import numpy as np
+
+from dataset import ADIM_FIELDS, TRAJECTORY_FIELDS, compress, encode_infos, find_info_keys, recorded_fields
+from sweep import load_worker
+from scheduler import available_cpus
+
+
+# HalfCheetah-v5
+FIELD_WIDTHS = dict(observations=17, actions=6, rewards=1, adim_observations=17, adim_actions=6)
+INFO_KEYS = ["x_position", "x_velocity", "reward_forward", "reward_ctrl"]
+
+Estimate = namedtuple(
+    "Estimate",
+    ["nb_contexts", "seconds_per_context", "startup_seconds", "context_bytes", "output_bytes", "worker_bytes", "codec"],
+)
+
+
+## Sizes
+
+def info_bytes(nb_keys):
+    """Memory taken by one info dict of nb_keys numpy floats, with its pointer."""
+    info = {f"key{i}": np.float64(0) for i in range(nb_keys)}
+    return 8 + sys.getsizeof(info) + nb_keys * sys.getsizeof(np.float64(0))
+
+
+def trajectory_bytes(arrays):
+    """Memory taken by the trajectory arrays of a context, info dicts included."""
+    total = 0
+    for name, array in arrays.items():
+        if name == "infos":
+            total += np.size(array) * info_bytes(len(find_info_keys(array)))
+        else:
+            total += np.asarray(array).nbytes
+    return total
+
+
+def stored_bytes(arrays, codec, level=None):
+    """Size of the trajectory arrays of a context once written with codec, or gzipped by pickle."""
+    if codec == "pickle":
+        return len(gzip.compress(pickle.dumps(arrays)))
+
+    total = 0
+    for name, array in arrays.items():
+        if name == "infos":
+            array = encode_infos(array, find_info_keys(array))
+        data = np.ascontiguousarray(array).tobytes()
+        total += len(data) if codec == "none" else len(compress(codec, data, level))
+    return total
+
+
+def process_rss():
+    with open("/proc/self/statm") as file:
+        return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def memory_available():
+    with open("/proc/meminfo") as file:
+        for line in file:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+## Estimates
+
+def evaluate_samples(job, sample):
+    """Evaluate the sample like the sweep, in a fresh process, see `measure_sweep`.
+
+    Returns the `(index, data)` results, the seconds of each context, the startup
+    seconds and the memory of the process, that of a worker.
+    """
+    start = time.perf_counter()
+    backend = job.get("backend", "gym")
+
+    if backend == "gym":
+        worker = load_worker(job)
+        startup = time.perf_counter() - start
+
+        results, elapsed = [], []
+        for context in sample:
+            start = time.perf_counter()
+            results.append(worker(context))
+            elapsed.append(time.perf_counter() - start)
+    else:
+        module = importlib.import_module(job["generator"])
+        startup = time.perf_counter() - start
+
+        # one batch of the sample, the model loading is part of its time
+        start = time.perf_counter()
+        results = list(module.process_contexts_batched(
+            sample, job["base"], job["nb_episodes"], job["xml_dir"], job["original_context"],
+            job.get("nb_steps", 1000), backend, len(sample), job.get("adimensional", False), job.get("seed", 0),
+        ))
+        elapsed = [(time.perf_counter() - start) / len(sample)] * len(sample)
+
+    return results, elapsed, startup, process_rss()
+
+
+def measure_sweep(job, contexts, nb_samples=3, codec="zstd", level=None):
+    """Estimate a sweep by evaluating a few of its contexts with its backend.
+
+    The samples are spread over the sweep, the cost of a context depends on where it
+    is. They're evaluated in a fresh process, whose memory is that of a worker. The
+    recorded fields and their dtypes are those of the sampled results. Returns the
+    estimate and the results, by position of their context in contexts, so the
+    sweep doesn't evaluate them again.
+    """
+    nb_samples = min(len(contexts), nb_samples)
+    positions = list(dict.fromkeys(np.linspace(0, len(contexts) - 1, nb_samples).astype(int).tolist()))
+
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        results, elapsed, startup, worker_bytes = pool.apply(evaluate_samples, (job, [contexts[i] for i in positions]))
+
+    context_bytes, output_bytes = [], []
+    for _, data in results:
+        # (context, xml, b1, b2, b3, observations, actions, rewards, infos, ...)
+        arrays = dict(zip(recorded_fields(job.get("adimensional", False)), data[5:]))
+        scalars = len(pickle.dumps(data[:5]))
+        context_bytes.append(trajectory_bytes(arrays) + scalars)
+        output_bytes.append(stored_bytes(arrays, codec, level) + scalars)
+
+    estimate = Estimate(
+        nb_contexts=len(contexts),
+        seconds_per_context=np.mean(elapsed),
+        startup_seconds=startup,
+        context_bytes=np.mean(context_bytes),
+        output_bytes=np.mean(output_bytes),
+        worker_bytes=worker_bytes,
+        codec=codec,
+    )
+    return estimate, dict(zip(positions, results))
+
+
+def analytic_sweep(nb_contexts, nb_episodes, nb_steps=1000, fields=TRAJECTORY_FIELDS, dtype=np.float64,
+                   seconds_per_step=None, compression_ratio=1, codec="none"):
+    """Estimate a sweep from its parameters only, without running any context.
+
+    The time is only estimated with seconds_per_step, the output size is the raw size
+    divided by compression_ratio.
+    """
+    itemsize = np.dtype(dtype).itemsize
+    nb_values = sum(FIELD_WIDTHS[name] for name in fields if name != "infos")
+    per_step = nb_values * itemsize
+    stored_per_step = per_step
+
+    if "infos" in fields:
+        per_step += info_bytes(len(INFO_KEYS))
+        stored_per_step += len(INFO_KEYS) * 8
+
+    nb_episode_steps = nb_episodes * nb_steps
+
+    return Estimate(
+        nb_contexts=nb_contexts,
+        seconds_per_context=np.nan if seconds_per_step is None else seconds_per_step * nb_episode_steps,
+        startup_seconds=0,
+        context_bytes=per_step * nb_episode_steps,
+        output_bytes=stored_per_step * nb_episode_steps / compression_ratio,
+        worker_bytes=0,
+        codec=codec,
+    )
+
+
+def wall_seconds(estimate, nb_workers):
+    """Projected duration with nb_workers, assuming the workers don't slow each other down.
+
+    `scheduler.calibrate` measures the actual throughput of a layout.
+    """
+    return estimate.startup_seconds + math.ceil(estimate.nb_contexts / nb_workers) * estimate.seconds_per_context
+
+
+def peak_bytes(estimate, nb_workers):
+    """Projected peak memory, the generators keep all the results until the end.
+
+    Pickling is assumed to need up to its output in memory on top of the results.
+    """
+    peak = estimate.nb_contexts * estimate.context_bytes + nb_workers * estimate.worker_bytes
+    if estimate.codec == "pickle":
+        peak += estimate.nb_contexts * estimate.output_bytes
+    return peak
+
+
+def output_size(estimate):
+    return estimate.nb_contexts * estimate.output_bytes
+
+
+def check_sweep(estimate, nb_workers, outdir, max_hours=None):
+    """Reasons why the sweep can't be completed on this machine, empty if it's feasible."""
+    problems = []
+
+    memory = memory_available()
+    if peak_bytes(estimate, nb_workers) > memory:
+        problems.append(f"needs {peak_bytes(estimate, nb_workers) / 1e9:.1f} GB of memory, {memory / 1e9:.1f} GB available")
+
+    outdir = Path(outdir)
+    while not outdir.exists():
+        outdir = outdir.parent
+    free = shutil.disk_usage(outdir).free
+    if output_size(estimate) > free:
+        problems.append(f"needs {output_size(estimate) / 1e9:.1f} GB of disk, {free / 1e9:.1f} GB free")
+
+    hours = wall_seconds(estimate, nb_workers) / 3600
+    if max_hours is not None and hours > max_hours:
+        problems.append(f"takes {hours:.1f} h with {nb_workers} workers, more than {max_hours} h")
+
+    return problems
+
+
+def format_estimate(estimate, workers=None):
+    nb_cpus = len(available_cpus())
+    workers = workers or sorted({1, 2, 4, 8, 16, 32, 64, nb_cpus})
+    lines = [
+        f"{estimate.nb_contexts} contexts, {estimate.seconds_per_context:.2f} s per context, "
+        f"{estimate.context_bytes / 1e6:.1f} MB per context in memory, "
+        f"{output_size(estimate) / 1e9:.2f} GB of output ({estimate.codec})"
+    ]
+    for nb_workers in workers:
+        lines.append(
+            f"  {nb_workers:3d} workers: {wall_seconds(estimate, nb_workers) / 3600:8.2f} h, "
+            f"{peak_bytes(estimate, nb_workers) / 1e9:7.2f} GB peak memory"
+            f"{f' (more than the {nb_cpus} cores here)' if nb_workers > nb_cpus else ''}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Estimate the duration, peak memory and output size of a sweep from its parameters.")
+    parser.add_argument("num", nargs=3, type=int, help="num_1, num_2 and num_3 of the sweep")
+    parser.add_argument("-e", "--episodes", type=int, default=10, help="episodes per context")
+    parser.add_argument("-s", "--steps", type=int, default=1000, help="steps per episode")
+    parser.add_argument("-f", "--fields", nargs="+", choices=TRAJECTORY_FIELDS + ADIM_FIELDS, default=TRAJECTORY_FIELDS, help="recorded trajectory fields")
+    parser.add_argument("--dtype", default="float64", help="dtype of the trajectory arrays")
+    parser.add_argument("--seconds-per-step", type=float, default=None, help="measured time of an env and policy step")
+    parser.add_argument("--ratio", type=float, default=1, help="expected compression ratio of the output")
+    parser.add_argument("-w", "--workers", nargs="+", type=int, default=None, help="worker counts to project the duration for")
+    parser.add_argument("-o", "--outdir", type=Path, default=Path("output") / "data", help="where the output will be written, to check the free space")
+    parser.add_argument("--max-hours", type=float, default=None, help="refuse sweeps longer than this")
+    args = parser.parse_args()
+
+    estimate = analytic_sweep(
+        math.prod(args.num) + 1,  # with the original context
+        args.episodes,
+        args.steps,
+        args.fields,
+        args.dtype,
+        args.seconds_per_step,
+        args.ratio,
+    )
+    print(format_estimate(estimate, args.workers))
+
+    problems = check_sweep(estimate, max(args.workers or [1]), args.outdir, args.max_hours)
+    for problem in problems:
+        print(f"error: the sweep {problem}", file=sys.stderr)
+    if problems:
+        exit(1)
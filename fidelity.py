@@ -0,0 +1,69 @@
+import numpy as np
+
+from dataset import info_values
+
+
+FIDELITIES = ["full", "screen"]
+
+
+## Screening
+
+def screen(observations, rewards, infos, min_forward=0.0):
+    """Verdict of a short screening rollout: "fail", "ambiguous" or "promising".
+
+    An episode fails when the cheetah flipped or its forward reward per step is below
+    min_forward. The rollout fails when all its episodes failed, is ambiguous when
+    only some did and is promising otherwise.
+    """
+    flipped = (np.abs(np.asarray(observations[..., 1])) > np.pi / 1.8).any(axis=-1)
+    forward = info_values(infos, "reward_forward").mean(axis=-1)
+    failed = flipped | (forward < min_forward)
+
+    if failed.all():
+        return "fail"
+    if failed.any():
+        return "ambiguous"
+    return "promising"
+
+
+def pad_evaluation(evaluation, nb_episodes, nb_steps):
+    """Pad the (observations, actions, rewards, infos, ...) of a rollout to nb_episodes x nb_steps.
+
+    The missing steps are NaN, and info dicts of NaN, so the rows of screened out
+    contexts have the shapes of the fully evaluated ones. The arrays after the infos,
+    like the adimensional observations and actions, are padded with NaN too.
+    """
+    observations, actions, rewards, infos, *others = evaluation
+
+    def pad(array):
+        full = np.full((nb_episodes, nb_steps) + array.shape[2:], np.nan)
+        full[:array.shape[0], :array.shape[1]] = array
+        return full
+
+    padded = [pad(array) for array in (observations, actions, rewards)]
+
+    keys = next((info.keys() for info in infos.flat if info is not None), [])
+    full = np.full((nb_episodes, nb_steps), None)
+    for idx in np.ndindex(full.shape):
+        full[idx] = dict.fromkeys(keys, np.nan)
+    full[:infos.shape[0], :infos.shape[1]] = infos
+    padded.append(full)
+
+    return tuple(padded) + tuple(pad(array) for array in others)
+
+
+def multi_fidelity(evaluate, nb_episodes, nb_steps, screening=None):
+    """Evaluate with `evaluate(nb_episodes, nb_steps)`, screening first if asked.
+
+    screening is a dict of the nb_episodes and nb_steps of a short rollout and the
+    min_forward of `screen`. Contexts whose screening fails are not evaluated further,
+    their padded screening rollout is returned with the fidelity "screen", the others
+    are fully evaluated with the fidelity "full".
+    """
+    if screening is not None:
+        screening = dict(screening)
+        evaluation = evaluate(screening.pop("nb_episodes"), screening.pop("nb_steps"))
+        if screen(evaluation[0], evaluation[2], evaluation[3], **screening) == "fail":
+            return pad_evaluation(evaluation, nb_episodes, nb_steps), "screen"
+
+    return evaluate(nb_episodes, nb_steps), "full"
@@ -0,0 +1,244 @@
+import numpy as np
+import pandas as pd
+
+from batch_context import adimensional_values, values_matrix
+
+
+## Axes of the sweeps
+
+def sweep_axes(df, base):
+    """Coordinates of the contexts of a dataset, as a frame with the same index.
+
+    The base values (the b1, b2 and b3 columns, named after base) and the values of
+    the symbols which were changed independently of the base, i.e. whose value and
+    adimensional value both change between contexts.
+    """
+    contexts = list(df["context"])
+    axes = pd.DataFrame({name: df[b].to_numpy() for name, b in zip(base, ["b1", "b2", "b3"])}, index=df.index)
+
+    values = values_matrix(contexts)
+    adim = adimensional_values(contexts, contexts[0], base)
+    changed = ~np.all(np.isclose(adim, adim[:1]), axis=0) & ~np.all(np.isclose(values, values[:1]), axis=0)
+
+    for i in np.flatnonzero(changed):
+        symbol = contexts[0].symbols[i]
+        if symbol not in axes:
+            axes[symbol] = values[:, i]
+
+    return axes
+
+
+def axis_coords(values, rtol=1e-9):
+    """Sorted distinct values, those closer than rtol being the same coordinate."""
+    values = np.unique(values)
+    keep = np.r_[True, np.diff(values) > rtol * np.abs(values[1:])]
+    return values[keep]
+
+
+def nearest(coords, values):
+    """Position in the sorted coords of the nearest coordinate of each value."""
+    if len(coords) == 1:
+        return np.zeros(len(values), dtype=int)
+
+    right = np.clip(np.searchsorted(coords, values), 1, len(coords) - 1)
+    left = right - 1
+    return np.where(values - coords[left] < coords[right] - values, left, right)
+
+
+def cell_edges(coords, log=True):
+    """Edges of the cells centered on coords, geometrically centered with log."""
+    if len(coords) == 1:
+        return coords * np.array([0.9, 1.1]) if log else coords + np.array([-0.5, 0.5])
+
+    log = log and np.all(coords > 0)
+    centers = np.log(coords) if log else coords
+    middles = (centers[1:] + centers[:-1]) / 2
+    edges = np.r_[2 * centers[0] - middles[0], middles, 2 * centers[-1] - middles[-1]]
+
+    return np.exp(edges) if log else edges
+
+
+## Grids
+
+class Grid:
+    """Numeric columns of a sweep as N-D arrays indexed by its axes.
+
+    `coords` maps each axis to its sorted coordinates and `data` each column to an
+    array of shape `tuple(len(c) for c in coords.values())`, NaN where the sweep has
+    no context. Slicing and plotting are array operations.
+    """
+
+    def __init__(self, coords, data):
+        self.coords = coords
+        self.data = data
+
+    @property
+    def dims(self):
+        return list(self.coords)
+
+    @property
+    def shape(self):
+        return tuple(len(c) for c in self.coords.values())
+
+    @property
+    def columns(self):
+        return list(self.data)
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    def __setitem__(self, column, values):
+        self.data[column] = np.array(np.broadcast_to(values, self.shape), dtype=np.float64)
+
+    def __repr__(self):
+        dims = ", ".join(f"{dim}: {n}" for dim, n in zip(self.dims, self.shape))
+        return f"Grid({dims}; {', '.join(self.columns)})"
+
+    def isel(self, **indices):
+        """Select positions along axes, an int drops the axis, a slice or array keeps it."""
+        data = self.data
+        # from the last axis, so dropping one doesn't move those left to select
+        for axis, dim in reversed(list(enumerate(self.dims))):
+            if dim in indices:
+                index = indices[dim]
+                if isinstance(index, slice):
+                    index = np.arange(len(self.coords[dim]))[index]
+                data = {column: np.take(values, index, axis=axis) for column, values in data.items()}
+
+        coords = {dim: c[indices[dim]] if dim in indices else c for dim, c in self.coords.items()}
+        coords = {dim: c for dim, c in coords.items() if np.ndim(c) == 1}
+
+        return Grid(coords, data)
+
+    def sel(self, **values):
+        """Select the nearest coordinates along axes, dropping them."""
+        return self.isel(**{dim: int(nearest(self.coords[dim], np.array([v]))[0]) for dim, v in values.items()})
+
+    def squeeze(self):
+        """Drop the axes of a single coordinate."""
+        return self.isel(**{dim: 0 for dim, c in self.coords.items() if len(c) == 1})
+
+    def pcolormesh(self, C, x, y, ax=None, xscale="log", yscale="log", **kwargs):
+        """Plot a column, or an array of the grid's shape, over the axes x and y.
+
+        The other axes must be of a single coordinate, `sel` the others first.
+        """
+        from matplotlib import pyplot as plt
+
+        values = self[C] if isinstance(C, str) else np.broadcast_to(C, self.shape)
+        grid = self.squeeze()
+        values = values.reshape(grid.shape)
+        if sorted(grid.dims) != sorted([x, y]):
+            raise ValueError(f"can't plot {grid.dims} over {x} and {y}, select the other axes first")
+
+        Z = values.T if grid.dims == [x, y] else values
+        ax = ax or plt.gca()
+        mesh = ax.pcolormesh(
+            cell_edges(grid.coords[x], xscale == "log"),
+            cell_edges(grid.coords[y], yscale == "log"),
+            np.ma.masked_invalid(Z),
+            **kwargs,
+        )
+        ax.set_xscale(xscale)
+        ax.set_yscale(yscale)
+
+        return mesh
+
+    def to_frame(self):
+        """Long frame of the grid, one row per point."""
+        index = pd.MultiIndex.from_product(list(self.coords.values()), names=self.dims)
+        return pd.DataFrame({column: values.ravel() for column, values in self.data.items()}, index=index)
+
+    def to_xarray(self):
+        """The grid as an `xarray.Dataset`, needs xarray."""
+        import xarray as xr
+
+        return xr.Dataset({column: (self.dims, values) for column, values in self.data.items()}, coords=self.coords)
+
+
+def axes_frame(df, axes):
+    if isinstance(axes, pd.DataFrame):
+        return axes.loc[df.index]
+    return df[list(axes)]
+
+
+def numeric_columns(df, coordinates):
+    return [c for c in df.select_dtypes("number").columns if c not in coordinates.columns]
+
+
+def to_grid(df, axes, columns=None, rtol=1e-9):
+    """Grid of the numeric columns of df over axes, columns of df or of `sweep_axes`.
+
+    axes can be column names of df or a frame of coordinates with the same index,
+    like the one of `sweep_axes`. Contexts outside the grid (like "original") should
+    be dropped first, the axes are the distinct coordinates of all the rows.
+    """
+    coordinates = axes_frame(df, axes)
+    if columns is None:
+        columns = numeric_columns(df, coordinates)
+
+    coords = {}
+    positions = []
+    for dim in coordinates.columns:
+        values = coordinates[dim].to_numpy(dtype=np.float64)
+        coords[dim] = axis_coords(values, rtol)
+        positions.append(nearest(coords[dim], values))
+
+    shape = tuple(len(c) for c in coords.values())
+    data = {}
+    for column in columns:
+        values = np.full(shape, np.nan)
+        values[tuple(positions)] = df[column].to_numpy(dtype=np.float64)
+        data[column] = values
+
+    return Grid(coords, data)
+
+
+def interpolate_grid(df, axes, columns=None, nb_points=100, log=True, method="linear", rtol=1e-9):
+    """Grid of scattered results, like those of `sampling.sample_contexts`, interpolated.
+
+    Each axis gets nb_points coordinates spanning the samples, log-spaced with log,
+    and the columns are interpolated in (log) axes space with
+    `scipy.interpolate.griddata`. Points outside the convex hull of the samples are
+    NaN. Axes of a single value are kept as a single coordinate, if no axis varies
+    each column is the mean of its samples.
+    """
+    from scipy.interpolate import griddata
+
+    coordinates = axes_frame(df, axes)
+    if columns is None:
+        columns = numeric_columns(df, coordinates)
+
+    coords = {}
+    samples, mesh_axes = [], []
+    for dim in coordinates.columns:
+        values = coordinates[dim].to_numpy(dtype=np.float64)
+        low, high = values.min(), values.max()
+        if high - low <= rtol * abs(high):
+            coords[dim] = np.array([values.mean()])
+            continue
+
+        dim_log = log and low > 0
+        coords[dim] = np.geomspace(low, high, nb_points) if dim_log else np.linspace(low, high, nb_points)
+        samples.append(np.log(values) if dim_log else values)
+        mesh_axes.append(np.log(coords[dim]) if dim_log else coords[dim])
+
+    shape = tuple(len(c) for c in coords.values())
+    if not samples:
+        # a degenerate sweep, all the samples are at the same point
+        return Grid(coords, {column: np.full(shape, np.nanmean(df[column].to_numpy(dtype=np.float64))) for column in columns})
+
+    mesh = np.stack([m.ravel() for m in np.meshgrid(*mesh_axes, indexing="ij")], axis=-1)
+    samples = np.stack(samples, axis=-1)
+
+    data = {}
+    for column in columns:
+        values = df[column].to_numpy(dtype=np.float64)
+        if samples.shape[1] == 1:
+            order = np.argsort(samples[:, 0])
+            interpolated = np.interp(mesh[:, 0], samples[order, 0], values[order])
+        else:
+            interpolated = griddata(samples, values, mesh, method=method)
+        data[column] = interpolated.reshape(shape)
+
+    return Grid(coords, data)
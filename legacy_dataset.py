@@ -0,0 +1,155 @@
+import argparse
+from pathlib import Path
+import re
+import sys
+import tempfile
+
+from pipoli.core import Context, Dimension
+
+from dataset import CODECS, DatasetWriter, load_spilled, stored_array, stored_layout
+
+
+BASE_DIMENSIONS = [
+    M := Dimension([1, 0, 0]),
+    L := Dimension([0, 1, 0]),
+    T := Dimension([0, 0, 1]),
+]
+
+# symbols the contexts gained after the pre_weight_update generators, with the values
+# they implied: the joint defaults of the HalfCheetah-v5 XML and the reward weights of the env
+MISSING_SYMBOLS = [
+    ("armature", M*L**2, 0.1),
+    ("damping", M*L**2/T, 0.01),
+    ("stiffness", M*L**2/T**2, 8),
+    ("forward_reward_weight", T/L, 1),
+    ("ctrl_cost_weight", T**4/M**2/L**4, 0.1),
+]
+
+JOINT_DEFAULTS = re.compile(r'<joint armature="([^"]+)" damping="([^"]+)"[^>]*stiffness="([^"]+)"')
+
+# legacy file name: data-{kind}-{base}-{range_1}-{range_2}-{range_3}-{num_1}-{num_2}-{num_3}-{b}.pkl.gz
+LEGACY_KINDS = ["similar", "non-similar", "naive-similar"]
+
+
+## Conversion
+
+def convert_context(context, xml=None):
+    """The legacy context with the symbols it lacks, as implied by its XML if given."""
+    missing = {sym: (dim, value) for sym, dim, value in MISSING_SYMBOLS if sym not in context.symbols}
+
+    match = JOINT_DEFAULTS.search(xml) if xml else None
+    if match is not None:
+        for sym, value in zip(["armature", "damping", "stiffness"], match.groups()):
+            if sym in missing:
+                missing[sym] = (missing[sym][0], float(value))
+
+    quantities = list(zip(context.symbols, context.dimensions, context.values))
+    quantities += [(sym, dim, value) for sym, (dim, value) in missing.items()]
+
+    return Context(BASE_DIMENSIONS, *zip(*quantities))
+
+
+def legacy_range(exponents, b):
+    """Factors of a legacy log-space range of exponents of b, like the geom ranges."""
+    factors = tuple(float(b) ** e for e in exponents)
+    return tuple(int(f) if f.is_integer() else f for f in factors)
+
+
+def convert_attrs(attrs, file_name, filled):
+    """attrs of the current generators for those of a legacy data frame."""
+    attrs = dict(attrs)
+    legacy = {key: attrs.pop(key) for key in ["space", "b", "range_1", "range_2", "range_3"] if key in attrs}
+    legacy["file"] = file_name
+    legacy["filled_symbols"] = filled
+
+    if legacy.get("space") == "log":
+        attrs["space"] = "geom"
+        for key in ["range_1", "range_2", "range_3"]:
+            attrs[key] = legacy_range(legacy[key], legacy["b"])
+    else:
+        attrs.update((key, legacy[key]) for key in ["space", "range_1", "range_2", "range_3"] if key in legacy)
+
+    attrs.setdefault("sampling", None)
+    attrs.setdefault("active_learning", None)
+    attrs.setdefault("nb_steps", 1000)
+    attrs.setdefault("screening", None)
+    attrs.setdefault("backend", "gym")
+    attrs.setdefault("adimensional", False)
+    attrs["legacy"] = legacy
+    attrs["comment"] = attrs.get("comment", "") + "\nconverted from a pre_weight_update dataset, " \
+        f"the missing {', '.join(filled)} are the values implied by its env"
+
+    return attrs
+
+
+def legacy_kind(file_name):
+    name = file_name.removeprefix("data-")
+    for kind in sorted(LEGACY_KINDS, key=len, reverse=True):
+        if name.startswith(kind + "-"):
+            return kind
+    raise ValueError(f"'{file_name}' is not the name of a legacy dataset")
+
+
+def converted_name(file_name, attrs):
+    """Name of the converted dataset, like those of the current generators."""
+    base = attrs["base"]
+    return f"data-{legacy_kind(file_name)}-{str(base)[1:-1].replace(', ', '-')}-{attrs['space']}-" \
+        f"{attrs['range_1']}-{attrs['range_2']}-{attrs['range_3']}-{attrs['num_1']}-{attrs['num_2']}-{attrs['num_3']}"
+
+
+def convert_legacy(path, outdir=None, codec="zstd", level=None, threads=None, spill_dir=None):
+    """Convert a legacy `.pkl.gz` data frame to a dataset directory, one context at a time.
+
+    The trajectories are first spilled to a temporary file next to the output (or in
+    spill_dir) while unpickling, then each context is read back, its context gets
+    the symbols of `MISSING_SYMBOLS` and it's written to the dataset. The memory
+    stays about that of a few contexts, the disk needs the size of the trajectories
+    twice until the conversion ends.
+    """
+    path = Path(path)
+    outdir = Path(outdir) if outdir is not None else None
+
+    with tempfile.TemporaryFile(dir=spill_dir or (outdir or path).parent) as spill_file:
+        df = load_spilled(path, spill_file)
+
+        fields = [name for name in ["observations", "actions", "rewards", "infos"] if name in df.columns]
+        columns = [c for c in df.columns if c not in fields]
+        first = df.iloc[0]
+        shapes = {name: stored_layout(first[name])[0] for name in fields}
+        info_keys = list(stored_layout(first["infos"])[1].names) if "infos" in fields else None
+
+        filled = [sym for sym, _, _ in MISSING_SYMBOLS if sym not in first["context"].symbols]
+        attrs = convert_attrs(df.attrs, path.name, filled)
+        if outdir is None:
+            outdir = path.parent / (converted_name(path.name, attrs) + ".ds")
+
+        with DatasetWriter(outdir, len(df), shapes, info_keys, attrs, codec, level, threads) as writer:
+            for position, (index, values) in enumerate(zip(df.index, df.itertuples(index=False, name=None))):
+                row = dict(zip(df.columns, values))
+                arrays = {name: stored_array(row.pop(name)) for name in fields}
+                row["context"] = convert_context(row["context"], row.get("xml"))
+                row.setdefault("fidelity", "full")
+                writer.write(position, index, {c: row[c] for c in columns + ["fidelity"]}, arrays)
+
+    return outdir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the datasets of the pre_weight_update generators to dataset directories.")
+    parser.add_argument("infile", nargs=1, type=Path, help="the legacy '.pkl.gz' data frame to convert")
+    parser.add_argument("-o", "--outdir", type=Path, help="the dataset directory to create, defaults to the name of the current generators")
+    parser.add_argument("-c", "--codec", choices=CODECS, default="zstd", help="compression of the trajectories, 'none' allows memory mapping them")
+    parser.add_argument("-l", "--level", type=int, default=None, help="compression level of the codec")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="number of compression threads, defaults to the number of cores")
+    parser.add_argument("--spill-dir", type=Path, default=None, help="directory of the temporary file of the trajectories, defaults to that of the output")
+    args = parser.parse_args()
+
+    file, = args.infile
+
+    if not (file.exists() and file.is_file()):
+        print(f"error: '{file}' is not a file", file=sys.stderr)
+        exit(1)
+
+    print("converting...")
+    outdir = convert_legacy(file, args.outdir, args.codec, args.level, args.threads, args.spill_dir)
+    print(f"done, wrote '{outdir}'.")
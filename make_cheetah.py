@@ -1,6 +1,9 @@
 from pathlib import Path
+import string
 import numpy as np
 
+from batch_context import values_matrix
+
 HALF_CHEETAH = """<!-- Generated Cheetah Model
 
     The state space is populated with joints in the order that they are
@@ -110,130 +113,116 @@ def make_cheetah_xml(context, torso_pos_z=None, name="context", outdir="./output
     return str(cheetah_xml.absolute())
 
 def make_cheetah(context, torso_pos_z=None):
-    dt = context.value("dt")
-    m = context.value("m")
-    g = context.value("g")
-    taumax = context.value("taumax")
-    armature = context.value("armature")
-    damping = context.value("damping")
-    stiffness = context.value("stiffness")
-
-    solref_1 = .00002  # timeconst orig .02
-    solreflimit_1 = .00002  # timeconst limit orig .02
-    solimp_3 = .00001  # width .01
-    solimplimit_3 = .00003  # width limit .03
-
-    L = context.value("L")
-    Lh = context.value("Lh")
-
-    l0 = context.value("l0")
-    l1 = context.value("l1")
-    l2 = context.value("l2")
-    l3 = context.value("l3")
-    l4 = context.value("l4")
-    l5 = context.value("l5")
-
-    k0 = context.value("k0")
-    k1 = context.value("k1")
-    k2 = context.value("k2")
-    k3 = context.value("k3")
-    k4 = context.value("k4")
-    k5 = context.value("k5")
-
-    b0 = context.value("b0")
-    b1 = context.value("b1")
-    b2 = context.value("b2")
-    b3 = context.value("b3")
-    b4 = context.value("b4")
-    b5 = context.value("b5")
-
-    d = context.value("d")
+    return render_cheetah(cheetah_params([context], torso_pos_z=torso_pos_z)[0])
+
+
+## Batches of contexts
+
+# the symbols of a context the model is made of
+CHEETAH_SYMBOLS = [
+    "dt", "m", "g", "taumax", "armature", "damping", "stiffness", "L", "Lh", "d",
+    "l0", "l1", "l2", "l3", "l4", "l5",
+    "k0", "k1", "k2", "k3", "k4", "k5",
+    "b0", "b1", "b2", "b3", "b4", "b5",
+]
+
+# the fields of HALF_CHEETAH, in order of first appearance
+PARAMS = list(dict.fromkeys(name for _, name, _, _ in string.Formatter().parse(HALF_CHEETAH) if name))
+
+
+def cheetah_params(contexts, symbols=None, torso_pos_z=None) -> np.ndarray:
+    """The PARAMS of the models of contexts, an (N, len(PARAMS)) array.
+
+    contexts are contexts or their (N, len(symbols)) values, like those of
+    `batch_context.values_matrix`, symbols defaults to those of the first context.
+    torso_pos_z is a number or an (N,) array.
+    """
+    if symbols is None:
+        symbols = contexts[0].symbols
+    values = values_matrix(contexts)
+    p = {sym: values[:, symbols.index(sym)] for sym in CHEETAH_SYMBOLS}
+
+    p["solref_1"] = .00002  # timeconst orig .02
+    p["solreflimit_1"] = .00002  # timeconst limit orig .02
+    p["solimp_3"] = .00001  # width .01
+    p["solimplimit_3"] = .00003  # width limit .03
+
+    L, d = p["L"], p["d"]
     r = d / 2
+    p["cam_y"] = 3 * L / .5
+    p["cam_z"] = .3 * L / .5
+    p["torso_pos_z"] = 0.7 * L / 0.5 if torso_pos_z is None else torso_pos_z
+    p["head_pos_x"] = L / 0.5 * 0.6
+    p["head_pos_z"] = d / 0.046 * 0.1
+
+    # scales of the limbs, from their length with the original capsule radius
+    s0 = (r + p["l0"]) / (0.046/2 + 0.145)
+    s1 = (r + p["l1"]) / (0.046/2 + 0.15)
+    s2 = (r + p["l2"]) / (0.046/2 + 0.094)
+    s3 = (r + p["l3"]) / (0.046/2 + 0.133)
+    s4 = (r + p["l4"]) / (0.046/2 + 0.106)
+    s5 = (r + p["l5"]) / (0.046/2 + 0.07)
+
+    p["bthight_pos_x"] = -L
+    p["bthight_geom_pos_x"] = s0 * 0.1
+    p["bthight_geom_pos_z"] = s0 * -0.13
+
+    p["bshin_pos_x"] = s0 * 0.16
+    p["bshin_pos_z"] = s0 * -0.25
+    p["bshin_geom_pos_x"] = s1 * -0.14
+    p["bshin_geom_pos_z"] = s1 * -0.07
+
+    p["bfoot_pos_x"] = s1 * -0.28
+    p["bfoot_pos_z"] = s1 * -0.14
+    p["bfoot_geom_pos_x"] = s2 * 0.03
+    p["bfoot_geom_pos_z"] = s2 * -0.097
+
+    p["fthight_pos_x"] = L
+    p["fthight_geom_pos_x"] = s3 * -0.07
+    p["fthight_geom_pos_z"] = s3 * -0.12
+
+    p["fshin_pos_x"] = s3 * -0.14
+    p["fshin_pos_z"] = s3 * -0.24
+    p["fshin_geom_pos_x"] = s4 * 0.065
+    p["fshin_geom_pos_z"] = s4 * -0.09
+
+    p["ffoot_pos_x"] = s4 * 0.13
+    p["ffoot_pos_z"] = s4 * -0.18
+    p["ffoot_geom_pos_x"] = s5 * 0.045
+    p["ffoot_geom_pos_z"] = s5 * -0.07
+
+    return np.stack(np.broadcast_arrays(*(p[name] for name in PARAMS)), axis=-1)
+
+
+class TemplateRenderer:
+    """A `str.format` template parsed once, rendered from rows of parameters.
+
+    fields are the names of the columns of the rows, e.g. PARAMS.
+    """
+
+    def __init__(self, template, fields):
+        # the fields become positions in the rows, so rendering doesn't look up names
+        pieces = []
+        for literal, name, spec, conversion in string.Formatter().parse(template):
+            pieces.append(literal.replace("{", "{{").replace("}", "}}"))
+            if name is not None:
+                conversion = f"!{conversion}" if conversion else ""
+                spec = f":{spec}" if spec else ""
+                pieces.append(f"{{{fields.index(name)}{conversion}{spec}}}")
+        self.format = "".join(pieces).format
+
+    def render(self, row):
+        return self.format(*(row.tolist() if isinstance(row, np.ndarray) else row))
+
+
+_renderer = TemplateRenderer(HALF_CHEETAH, PARAMS)
+
+
+def render_cheetah(params):
+    """The XML of a row of `cheetah_params`."""
+    return _renderer.render(params)
 
-    head_pos_x = L / 0.5 * 0.6
-    head_pos_z = d / 0.046 * 0.1
-
-    bthight_pos_x = -L
-    bthight_geom_pos_x = (r+l0) / (0.046/2 + 0.145) * 0.1
-    bthight_geom_pos_z = (r+l0) / (0.046/2 + 0.145) * -0.13
-
-    bshin_pos_x = (r+l0) / (0.046/2 + 0.145) * 0.16
-    bshin_pos_z = (r+l0) / (0.046/2 + 0.145) * -0.25
-    bshin_geom_pos_x = (r+l1) / (0.046/2 + 0.15) * -0.14
-    bshin_geom_pos_z = (r+l1) / (0.046/2 + 0.15) * -0.07
-
-    bfoot_pos_x = (r+l1) / (0.046/2 + 0.15) * -0.28
-    bfoot_pos_z = (r+l1) / (0.046/2 + 0.15) * -0.14
-    bfoot_geom_pos_x = (r+l2) / (0.046/2 + 0.094) * 0.03
-    bfoot_geom_pos_z = (r+l2) / (0.046/2 + 0.094) * -0.097
-
-    fthight_pos_x = L
-    fthight_geom_pos_x = (r+l3) / (0.046/2 + 0.133) * -0.07
-    fthight_geom_pos_z = (r+l3) / (0.046/2 + 0.133)* -0.12
-
-    fshin_pos_x = (r+l3) / (0.046/2 + 0.133) * -0.14
-    fshin_pos_z = (r+l3) / (0.046/2 + 0.133) * -0.24
-    fshin_geom_pos_x = (r+l4) / (0.046/2 + 0.106) * 0.065
-    fshin_geom_pos_z = (r+l4) / (0.046/2 + 0.106) * -0.09
-
-    ffoot_pos_x = (r+l4) / (0.046/2 + 0.106) * 0.13
-    ffoot_pos_z = (r+l4) / (0.046/2 + 0.106) * -0.18
-    ffoot_geom_pos_x = (r+l5) / (0.046/2 + 0.07) * 0.045
-    ffoot_geom_pos_z = (r+l5) / (0.046/2 + 0.07) * -0.07
-
-    if torso_pos_z is None:
-      torso_pos_z = 0.7 * L / 0.5
-    # torso_pos_z = max(
-    #     abs(bthight_geom_pos_z + bshin_geom_pos_z + bfoot_geom_pos_z - 2 * l3),
-    #     abs(fthight_geom_pos_z + fshin_geom_pos_z + ffoot_geom_pos_z - 2 * l5),
-    # )
-
-    return HALF_CHEETAH.format(
-        cam_y=3 * L / .5,
-        cam_z=.3 * L / .5,
-        dt=dt,
-        m=m, g=g, taumax=taumax,
-        armature=armature, damping=damping, stiffness=stiffness,
-        L=L, Lh=Lh, d=d,
-        l0=l0, l1=l1, l2=l2, l3=l3, l4=l4, l5=l5,
-        k0=k0, k1=k1, k2=k2, k3=k3, k4=k4, k5=k5,
-        b0=b0, b1=b1, b2=b2, b3=b3, b4=b4, b5=b5,
-
-        solref_1=solref_1,
-        solreflimit_1=solreflimit_1,
-        solimp_3=solimp_3,
-        solimplimit_3=solimplimit_3,
-
-        torso_pos_z=torso_pos_z,
-        head_pos_x=head_pos_x,
-        head_pos_z=head_pos_z,
-
-        bthight_pos_x=bthight_pos_x,
-        bthight_geom_pos_x=bthight_geom_pos_x,
-        bthight_geom_pos_z=bthight_geom_pos_z,
-    
-        bshin_pos_x=bshin_pos_x,
-        bshin_pos_z=bshin_pos_z,
-        bshin_geom_pos_x=bshin_geom_pos_x,
-        bshin_geom_pos_z=bshin_geom_pos_z,
-
-        bfoot_pos_x=bfoot_pos_x,
-        bfoot_pos_z=bfoot_pos_z,
-        bfoot_geom_pos_x=bfoot_geom_pos_x,
-        bfoot_geom_pos_z=bfoot_geom_pos_z,
-
-        fthight_pos_x=fthight_pos_x,
-        fthight_geom_pos_x=fthight_geom_pos_x,
-        fthight_geom_pos_z=fthight_geom_pos_z,
-    
-        fshin_pos_x=fshin_pos_x,
-        fshin_pos_z=fshin_pos_z,
-        fshin_geom_pos_x=fshin_geom_pos_x,
-        fshin_geom_pos_z=fshin_geom_pos_z,
-    
-        ffoot_pos_x=ffoot_pos_x,
-        ffoot_pos_z=ffoot_pos_z,
-        ffoot_geom_pos_x=ffoot_geom_pos_x,
-        ffoot_geom_pos_z=ffoot_geom_pos_z,
-    )
 
+def make_cheetahs(contexts, torso_pos_z=None):
+    """The XML of each context, like `make_cheetah`."""
+    return [render_cheetah(row) for row in cheetah_params(contexts, torso_pos_z=torso_pos_z)]
@@ -0,0 +1,158 @@
+import argparse
+from pathlib import Path
+import sys
+import tempfile
+import numpy as np
+
+from dataset import (
+    CODECS, STORED_FIELDS, DatasetWriter, is_dataset_dir, load_dataset, load_spilled, stored_array, stored_layout,
+    transfer_mode,
+)
+
+
+# attrs the sweeps must share to be merged, besides their transfer mode
+REQUIRED_ATTRS = ["base", "policy_info", "env"]
+
+
+## Merging
+
+def open_sweep(path, spill_file):
+    """A sweep output with lazy trajectories, a dataset directory or a pickled data frame."""
+    if is_dataset_dir(path):
+        return load_dataset(path)
+    return load_spilled(path, spill_file)
+
+
+def check_sweeps(names, frames):
+    """Problems which prevent merging the frames, an empty list if there are none."""
+    problems = []
+    first_name, first = names[0], frames[0]
+
+    modes = [transfer_mode(df.attrs, name) for name, df in zip(names, frames)]
+    for name, mode in zip(names, modes):
+        if None in mode:
+            problems.append(f"the transfer mode of '{name}' is unknown, its comment and name don't tell")
+    for name, mode in zip(names[1:], modes[1:]):
+        if None not in mode + modes[0] and mode != modes[0]:
+            problems.append(f"'{name}' is a {'-'.join(mode)} sweep, '{first_name}' is {'-'.join(modes[0])}")
+
+    for name, df in zip(names[1:], frames[1:]):
+        for key in REQUIRED_ATTRS:
+            if df.attrs.get(key) != first.attrs.get(key):
+                problems.append(f"'{name}' has the {key} {df.attrs.get(key)!r}, '{first_name}' has {first.attrs.get(key)!r}")
+
+    layouts = [sweep_layout(df) for df in frames]
+    for name, layout in zip(names[1:], layouts[1:]):
+        for field in layouts[0]:
+            if field not in layout:
+                problems.append(f"'{first_name}' has {field}, '{name}' hasn't")
+        for field, (shape, dtype) in layout.items():
+            if field not in layouts[0]:
+                problems.append(f"'{name}' has {field}, '{first_name}' hasn't")
+            elif layouts[0][field] != (shape, dtype):
+                problems.append(
+                    f"'{name}' has {field} of shape {shape} and dtype {dtype}, '{first_name}' of shape "
+                    f"{layouts[0][field][0]} and dtype {layouts[0][field][1]}"
+                )
+
+    return problems
+
+
+def sweep_layout(df):
+    """Stored shape and dtype of each trajectory, adimensional and sketch field of a sweep."""
+    if len(df) == 0:
+        return {}
+    first = df.iloc[0]
+    return {name: stored_layout(first[name]) for name in STORED_FIELDS if name in df.columns}
+
+
+def merge_attrs(names, frames):
+    """attrs shared by all the frames, the others are in attrs["shards"], one dict per frame."""
+    keys = list(dict.fromkeys(key for df in frames for key in df.attrs))
+    shared = [key for key in keys if all(key in df.attrs and df.attrs[key] == frames[0].attrs[key] for df in frames)]
+
+    attrs = {key: frames[0].attrs[key] for key in shared}
+    attrs["shards"] = [
+        dict(file=Path(name).name, nb_contexts=len(df), **{key: value for key, value in df.attrs.items() if key not in shared})
+        for name, df in zip(names, frames)
+    ]
+    return attrs
+
+
+def merge_datasets(paths, outdir, codec="zstd", level=None, threads=None, keep="first", spill_dir=None):
+    """Merge the outputs of several sweeps into one dataset directory, context by context.
+
+    The sweeps must have the same REQUIRED_ATTRS, transfer mode (see
+    `dataset.transfer_mode`) and trajectory shapes. Contexts evaluated by several
+    sweeps, found by their index, are taken from the first or last sweep given (keep). Only the small columns of the sweeps are in memory,
+    the trajectories are copied one context at a time, without decoding the infos.
+    Pickled data frames are first spilled to a temporary file, see `load_spilled`.
+    Returns the path of the dataset and the number of duplicates skipped.
+    """
+    if keep not in ("first", "last"):
+        raise ValueError(f"unknown keep '{keep}', expected 'first' or 'last'")
+
+    names = [str(path) for path in paths]
+    outdir = Path(outdir)
+
+    with tempfile.TemporaryFile(dir=spill_dir or outdir.parent) as spill_file:
+        frames = [open_sweep(path, spill_file) for path in paths]
+
+        problems = check_sweeps(names, frames)
+        if problems:
+            raise ValueError("the sweeps can't be merged:\n" + "\n".join(problems))
+
+        # position of each context in the sweeps, the duplicates are overwritten with keep="last"
+        sources = {}
+        duplicates = 0
+        for number, df in enumerate(frames):
+            for position, index in enumerate(df.index):
+                if index in sources:
+                    duplicates += 1
+                    if keep == "first":
+                        continue
+                sources[index] = (number, position)
+
+        layout = sweep_layout(frames[0])
+        fields = list(layout)
+        shapes = {name: shape for name, (shape, _) in layout.items()}
+        info_keys = list(layout["infos"][1].names) if "infos" in layout else None
+        columns = list(dict.fromkeys(c for df in frames for c in df.columns if c not in fields))
+
+        with DatasetWriter(outdir, len(sources), shapes, info_keys, merge_attrs(names, frames), codec, level, threads) as writer:
+            for position, (index, (number, source)) in enumerate(sources.items()):
+                df = frames[number]
+                row = df.iloc[source]
+                arrays = {name: stored_array(row[name]) for name in fields}
+                writer.write(position, index, {c: row.get(c, np.nan) for c in columns}, arrays)
+
+    return outdir, duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the outputs of several sweeps into one dataset directory.")
+    parser.add_argument("infiles", nargs="+", type=Path, help="the dataset directories or pickled data frames to merge")
+    parser.add_argument("-o", "--outdir", type=Path, required=True, help="the dataset directory to create")
+    parser.add_argument("-c", "--codec", choices=CODECS, default="zstd", help="compression of the trajectories, 'none' allows memory mapping them")
+    parser.add_argument("-l", "--level", type=int, default=None, help="compression level of the codec")
+    parser.add_argument("-t", "--threads", type=int, default=None, help="number of compression threads, defaults to the number of cores")
+    parser.add_argument("-k", "--keep", choices=["first", "last"], default="first", help="which sweep a context evaluated by several is taken from")
+    parser.add_argument("--spill-dir", type=Path, default=None, help="directory of the temporary file of pickled trajectories, defaults to that of the output")
+    args = parser.parse_args()
+
+    for file in args.infiles:
+        if not file.exists():
+            print(f"error: '{file}' doesn't exist", file=sys.stderr)
+            exit(1)
+    if args.outdir.exists():
+        print(f"error: '{args.outdir}' already exists", file=sys.stderr)
+        exit(1)
+
+    print("merging...")
+    try:
+        outdir, duplicates = merge_datasets(args.infiles, args.outdir, args.codec, args.level, args.threads, args.keep, args.spill_dir)
+    except ValueError as error:
+        print(f"error: {error}", file=sys.stderr)
+        exit(1)
+
+    print(f"done, wrote '{outdir}', skipped {duplicates} duplicate contexts.")
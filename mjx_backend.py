@@ -0,0 +1,233 @@
+from pathlib import Path
+import numpy as np
+
+from batch_context import transform_scales
+from make_cheetah import make_cheetah, make_cheetahs
+
+
+# those of HalfCheetah-v5
+FRAME_SKIP = 5
+RESET_NOISE_SCALE = 0.1
+INFO_KEYS = ["x_position", "x_velocity", "reward_forward", "reward_ctrl"]
+
+
+## Batched models
+
+def compile_model(context):
+    import mujoco
+    return mujoco.MjModel.from_xml_string(make_cheetah(context))
+
+
+def compile_models(contexts):
+    import mujoco
+    return [mujoco.MjModel.from_xml_string(xml) for xml in make_cheetahs(contexts)]
+
+
+def batch_models(models):
+    """One mjx model of the models, and the vmap axes of its fields.
+
+    The models all come from `HALF_CHEETAH` so they have the same structure, only the
+    fields which differ between them (masses, inertias, lengths, stiffness, damping,
+    gravity, timestep, ...) are stacked, the others are shared.
+    """
+    import jax
+    from mujoco import mjx
+
+    all_leaves = []
+    for model in models:
+        leaves, treedef = jax.tree.flatten(mjx.put_model(model))
+        all_leaves.append(leaves)
+
+    batched, in_axes = [], []
+    for leaves in zip(*all_leaves):
+        if all(np.array_equal(leaf, leaves[0]) for leaf in leaves[1:]):
+            batched.append(leaves[0])
+            in_axes.append(None)
+        else:
+            batched.append(jax.numpy.stack(leaves))
+            in_axes.append(0)
+
+    return jax.tree.unflatten(treedef, batched), jax.tree.unflatten(treedef, in_axes)
+
+
+class BatchedCheetah:
+    """HalfCheetah-v5 in many contexts at once, stepped with MJX on the CPU.
+
+    Each context is compiled from its `make_cheetah` XML like in the gym env, then the
+    parameters which differ between contexts are batched arrays of a single mjx model
+    and the physics of all the contexts is one vmapped and jitted step. Observations,
+    rewards and infos are those of the gym env, as (nb_contexts, ...) arrays. Needs
+    jax and mujoco-mjx, in double precision for parity with MuJoCo.
+    """
+
+    def __init__(self, contexts, frame_skip=FRAME_SKIP, reset_noise_scale=RESET_NOISE_SCALE):
+        import jax
+        jax.config.update("jax_enable_x64", True)
+        from mujoco import mjx
+
+        models = compile_models(contexts)
+        self.model, self.in_axes = batch_models(models)
+        self.nb_contexts = len(contexts)
+        self.nv = models[0].nv
+        self.frame_skip = frame_skip
+        self.reset_noise_scale = reset_noise_scale
+
+        self.init_qpos = np.array([model.qpos0 for model in models])
+        self.dt = np.array([model.opt.timestep * frame_skip for model in models])
+        self.forward_weight = np.array([context.value("forward_reward_weight") for context in contexts])
+        self.ctrl_weight = np.array([context.value("ctrl_cost_weight") for context in contexts])
+
+        template = mjx.make_data(models[0])
+
+        def set_state(model, qpos, qvel):
+            return mjx.forward(model, template.replace(qpos=qpos, qvel=qvel))
+
+        def step(model, data, action):
+            data = data.replace(ctrl=action)
+            return jax.lax.fori_loop(0, frame_skip, lambda _, d: mjx.step(model, d), data)
+
+        self._set_state = jax.jit(jax.vmap(set_state, in_axes=(self.in_axes, 0, 0)))
+        self._step = jax.jit(jax.vmap(step, in_axes=(self.in_axes, 0, 0)))
+        self.data = None
+
+    def observation(self):
+        qpos, qvel = np.asarray(self.data.qpos), np.asarray(self.data.qvel)
+        return np.concatenate([qpos[:, 1:], qvel], axis=1)
+
+    def set_state(self, qpos, qvel):
+        self.data = self._set_state(self.model, np.asarray(qpos), np.asarray(qvel))
+        return self.observation()
+
+    def reset(self, rngs):
+        """Reset all the contexts with the noise of the gym env, returns the observations.
+
+        rngs are the random generators of the contexts.
+        """
+        noise = self.reset_noise_scale
+        qpos = self.init_qpos + np.stack([rng.uniform(-noise, noise, self.init_qpos.shape[-1]) for rng in rngs])
+        qvel = noise * np.stack([rng.standard_normal(self.nv) for rng in rngs])
+        return self.set_state(qpos, qvel)
+
+    def step(self, actions):
+        """Step all the contexts, returns the observations, rewards and infos arrays."""
+        x_before = np.asarray(self.data.qpos[:, 0])
+        self.data = self._step(self.model, self.data, np.asarray(actions, dtype=np.float64))
+        x_after = np.asarray(self.data.qpos[:, 0])
+
+        x_velocity = (x_after - x_before) / self.dt
+        reward_forward = self.forward_weight * x_velocity
+        reward_ctrl = -self.ctrl_weight * np.sum(np.square(actions), axis=1)
+        infos = np.stack([x_after, x_velocity, reward_forward, reward_ctrl], axis=1)
+
+        return self.observation(), reward_forward + reward_ctrl, infos
+
+
+## Rollouts
+
+def transferred_policy(predict, original_context, contexts, base, obs_dims, act_dims, scaled=True):
+    """Batched policy of the original policy in each context, like those of `evaluate_policy`.
+
+    predict maps (N, 17) observations of the original context to its (N, 6) actions,
+    e.g. the `predict` of the SB3 model, it's called once per step for all the
+    contexts. Scaled, the observations are adimensionalized in their context and
+    re-dimensionalized in the original one with `batch_context.transform_scales`,
+    and the actions the other way, like `policy.to_scaled(context, base)`. Naive, the
+    original policy acts on the observations as they are. The policy maps the
+    (nb_contexts, ..., 17) observations to the (nb_contexts, ..., 6) actions.
+    """
+    factors = []
+    for dims in (obs_dims, act_dims):
+        scales = transform_scales(list(contexts) + [original_context], dims, base)
+        # from each context to the original one
+        factors.append(scales[-1] / scales[:-1] if scaled else np.ones_like(scales[:-1]))
+    obs_factors, act_factors = factors
+
+    def action(observations):
+        observations = np.asarray(observations, dtype=np.float64)
+        shape = (len(observations),) + (1,) * (observations.ndim - 2) + (-1,)
+        actions = predict((observations * obs_factors.reshape(shape)).reshape(-1, observations.shape[-1]))
+        actions = np.asarray(actions, dtype=np.float64).reshape(observations.shape[:-1] + (-1,))
+        return actions / act_factors.reshape(shape)
+
+    return action
+
+
+def info_dicts(infos):
+    """Info dicts of the (..., len(INFO_KEYS)) infos arrays, like those of the gym env."""
+    dicts = np.full(infos.shape[:-1], None)
+    for idx in np.ndindex(dicts.shape):
+        dicts[idx] = dict(zip(INFO_KEYS, infos[idx].tolist()))
+    return dicts
+
+
+def batched_rollouts(contexts, policy, nb_episodes, nb_steps=1000, seeds=None, cheetah=None):
+    """Evaluate a batched policy in all the contexts at once.
+
+    policy maps the (nb_contexts, 17) observations to the (nb_contexts, 6) actions,
+    e.g. `transferred_policy`. Returns the (observations, actions, rewards, infos) of
+    each context, with the shapes of `evaluate_policy`. seeds are those of the
+    contexts, so their results don't depend on the other contexts of the batch.
+    """
+    cheetah = cheetah or BatchedCheetah(contexts)
+    rngs = [np.random.default_rng(seed) for seed in seeds or [None] * len(contexts)]
+    nb_contexts = len(contexts)
+
+    observations = np.zeros((nb_contexts, nb_episodes, nb_steps, 17))
+    actions = np.zeros((nb_contexts, nb_episodes, nb_steps, 6))
+    rewards = np.zeros((nb_contexts, nb_episodes, nb_steps))
+    infos = np.zeros((nb_contexts, nb_episodes, nb_steps, len(INFO_KEYS)))
+
+    for ep in range(nb_episodes):
+        obs = cheetah.reset(rngs)
+        for step in range(nb_steps):
+            act = policy(obs)
+            observations[:, ep, step] = obs
+            actions[:, ep, step] = act
+            obs, rewards[:, ep, step], infos[:, ep, step] = cheetah.step(act)
+
+    infos = info_dicts(infos)
+    return [(observations[i], actions[i], rewards[i], infos[i]) for i in range(nb_contexts)]
+
+
+## Parity with the gym env
+
+def parity_check(context, policy, nb_steps=100, seed=0):
+    """Largest observation difference between the gym env and MJX at each step.
+
+    Both start from the same state after a reset of the gym env, then the actions of
+    the policy in the gym env are replayed in MJX. Small differences grow with time,
+    the divergence should stay within the contact tolerance over short horizons.
+    """
+    import tempfile
+    import gymnasium as gym
+
+    with tempfile.TemporaryDirectory() as tmp:
+        xml_file = Path(tmp) / "cheetah.xml"
+        xml_file.write_text(make_cheetah(context))
+        env = gym.make(
+            "HalfCheetah-v5",
+            xml_file=str(xml_file),
+            forward_reward_weight=context.value("forward_reward_weight"),
+            ctrl_cost_weight=context.value("ctrl_cost_weight"),
+            max_episode_steps=nb_steps,
+        )
+
+    obs, _ = env.reset(seed=seed)
+    qpos, qvel = env.unwrapped.data.qpos.copy(), env.unwrapped.data.qvel.copy()
+
+    gym_obs, gym_actions = [], []
+    for _ in range(nb_steps):
+        act = policy.action(obs)
+        gym_actions.append(act)
+        obs, *_ = env.step(act)
+        gym_obs.append(obs)
+    env.close()
+
+    cheetah = BatchedCheetah([context])
+    cheetah.set_state(qpos[None], qvel[None])
+    divergence = np.zeros(nb_steps)
+    for step, act in enumerate(gym_actions):
+        obs, _, _ = cheetah.step(np.asarray(act)[None])
+        divergence[step] = np.abs(obs[0] - gym_obs[step]).max()
+
+    return divergence
@@ -3,19 +3,21 @@ from pathlib import Path
 import sys
 import pandas as pd
 
+from dataset import dataset_codec, is_dataset_dir, load_dataset, write_dataset
+
 
 parser = argparse.ArgumentParser(description="Extract 'context', 'b1-3' and 'observations' columns from given dataframes.")
-parser.add_argument("infile", nargs=1, type=Path, help="the file containing the dataframe to extract data from")
+parser.add_argument("infile", nargs=1, type=Path, help="the file or dataset directory containing the dataframe to extract data from")
 args = parser.parse_args()
 
 file, = args.infile
 
-if not (file.exists() and file.is_file):
-    print(f"error: '{file}' is not a file", file=sys.stderr)
+if not file.exists():
+    print(f"error: '{file}' does not exist", file=sys.stderr)
     exit(1)
 
 print("loading...")
-all_data = pd.read_pickle(str(file.absolute()))
+all_data = load_dataset(file.absolute())
 
 out_df = all_data[["context", "b1", "b2", "b3", "observations"]]
 
@@ -24,7 +26,11 @@ out_df.attrs = all_data.attrs
 out_name = "observations-" + file.name
 out_path = file.parent / out_name
 
-print("pickling...")
-pd.to_pickle(out_df, str(out_path))
+if is_dataset_dir(file):
+    print("writing...")
+    write_dataset(out_df, out_path, *dataset_codec(file))
+else:
+    print("pickling...")
+    pd.to_pickle(out_df, str(out_path))
 
 print("done.")
\ No newline at end of file
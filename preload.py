@@ -0,0 +1,90 @@
+import base64
+import multiprocessing
+from multiprocessing import forkserver
+import os
+import pickle
+import random
+import time
+import numpy as np
+
+from sweep import load_worker
+
+
+JOB_VARIABLE = "SWEEP_PRELOAD_JOB"
+
+
+## In the forkserver
+
+_job = None
+_worker = None
+preload_seconds = None
+
+
+def preload():
+    """Load the worker of the job given by JOB_VARIABLE, once, before any worker is forked.
+
+    Runs when the forkserver imports this module, so the workers forked from it
+    start with torch, gymnasium, mujoco, ... imported and the policy loaded.
+    """
+    global _job, _worker, preload_seconds
+
+    encoded = os.environ.get(JOB_VARIABLE)
+    if encoded is None:
+        return
+
+    start = time.perf_counter()
+    try:
+        import torch
+        # thread pools don't survive a fork, none must be started before the workers are
+        torch.set_num_threads(1)
+        torch.set_num_interop_threads(1)
+    except (ImportError, RuntimeError):
+        pass
+
+    _job = base64.b64decode(encoded)
+    _worker = load_worker(pickle.loads(_job))
+    preload_seconds = time.perf_counter() - start
+
+
+def forkserver_context(job):
+    """A "forkserver" multiprocessing context whose server preloaded the worker of job.
+
+    The server is started once per process, if it already runs for another job the
+    workers load theirs as usual, see `preloaded_worker`.
+    """
+    ctx = multiprocessing.get_context("forkserver")
+
+    # the server inherits the environment when it starts
+    os.environ[JOB_VARIABLE] = base64.b64encode(pickle.dumps(job)).decode()
+    try:
+        ctx.set_forkserver_preload([__name__])
+        forkserver.ensure_running()
+    finally:
+        # only the server loads the job, not the processes started otherwise
+        del os.environ[JOB_VARIABLE]
+
+    return ctx
+
+
+## In the forked workers
+
+def preloaded_worker(job):
+    """The worker of job loaded by the forkserver, or None if it preloaded another one."""
+    if _worker is not None and _job == pickle.dumps(job):
+        return _worker
+    return None
+
+
+def reseed():
+    """New seeds for the RNGs, the forked workers inherit the state of the server."""
+    seed = int.from_bytes(os.urandom(4), "little")
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        import torch
+        torch.manual_seed(seed)
+    except ImportError:
+        pass
+
+
+preload()
@@ -0,0 +1,151 @@
+import os
+# offscreen rendering, must be set before mujoco is imported
+os.environ.setdefault("MUJOCO_GL", "egl")
+
+import argparse
+import multiprocessing
+from pathlib import Path
+import sys
+import numpy as np
+import gymnasium as gym
+
+from make_cheetah import make_cheetah
+
+
+## Simulation
+
+def simulate_states(context, policy, xml_file, nb_steps=1000):
+    """Run one episode and return the (nb_steps + 1, nq + nv) states and the env's dt."""
+    env = gym.make(
+        "HalfCheetah-v5",
+        xml_file=xml_file,
+        forward_reward_weight=context.value("forward_reward_weight"),
+        ctrl_cost_weight=context.value("ctrl_cost_weight"),
+        max_episode_steps=nb_steps,
+    )
+    data = env.unwrapped.data
+
+    obs, _ = env.reset()
+    states = [np.concatenate([data.qpos, data.qvel])]
+
+    trunc = False
+    while not trunc:
+        obs, _, _, trunc, _ = env.step(policy.action(obs))
+        states.append(np.concatenate([data.qpos, data.qvel]))
+
+    dt = env.unwrapped.dt
+    env.close()
+
+    return np.array(states), dt
+
+
+## Rendering
+
+def render_states(xml, states, outfile, fps, width=640, height=480, camera="track"):
+    """Render states with the camera of the model to a video, or to a directory of PNG images.
+
+    The output is a video if outfile has a video extension (.mp4, .gif, ...), which
+    needs imageio, and a directory of frames otherwise.
+    """
+    import mujoco
+
+    model = mujoco.MjModel.from_xml_string(xml)
+    data = mujoco.MjData(model)
+    renderer = mujoco.Renderer(model, height, width)
+    outfile = Path(outfile)
+
+    writer = None
+    if outfile.suffix:
+        import imageio
+        writer = imageio.get_writer(outfile, fps=fps)
+    else:
+        from matplotlib import pyplot as plt
+        outfile.mkdir(parents=True, exist_ok=True)
+
+    for i, state in enumerate(states):
+        data.qpos[:] = state[:model.nq]
+        data.qvel[:] = state[model.nq:]
+        mujoco.mj_forward(model, data)
+
+        renderer.update_scene(data, camera=camera)
+        frame = renderer.render()
+
+        if writer is not None:
+            writer.append_data(frame)
+        else:
+            plt.imsave(outfile / f"{i:05d}.png", frame)
+
+    if writer is not None:
+        writer.close()
+    renderer.close()
+
+    return str(outfile)
+
+
+def render_transfers(contexts, names, modes, original_policy, base, outdir, xml_dir, nb_steps=1000, nb_workers=None, ext=".mp4", **render_kwargs):
+    """Simulate the transfers of the original policy to the contexts and render them.
+
+    modes are "scaled" or "naive" transfers. The episodes are simulated in this
+    process while worker processes render and encode the previous ones, so rendering
+    does not slow down the simulation. Returns the rendered files.
+    """
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    Path(xml_dir).mkdir(parents=True, exist_ok=True)
+
+    pending = []
+    with multiprocessing.get_context("spawn").Pool(nb_workers) as pool:
+        for context, name in zip(contexts, names):
+            xml = make_cheetah(context)
+            xml_file = Path(xml_dir) / f"{name}.xml"
+            xml_file.write_text(xml)
+
+            for mode in modes:
+                policy = original_policy.to_scaled(context, base) if mode == "scaled" else original_policy
+                states, dt = simulate_states(context, policy, str(xml_file.absolute()), nb_steps)
+
+                outfile = outdir / f"{name}-{mode}{ext}"
+                pending.append(pool.apply_async(render_states, (xml, states, outfile, 1 / dt), render_kwargs))
+                print(f"simulated {name} ({mode})")
+
+        return [result.get() for result in pending]
+
+
+if __name__ == "__main__":
+    from dataset import load_dataset
+    from similar_transfer_data_gen import load_original_policy
+
+    parser = argparse.ArgumentParser(description="Render transfers to contexts of a dataset to videos, without a display.")
+    parser.add_argument("dataset", type=Path, help="the dataset containing the contexts")
+    parser.add_argument("names", nargs="+", help="the index of the contexts to render in the dataset, e.g. 'original'")
+    parser.add_argument("-m", "--modes", nargs="+", choices=["scaled", "naive"], default=["scaled", "naive"], help="the transfers to render")
+    parser.add_argument("-o", "--outdir", type=Path, default=Path("output") / "videos", help="where to write the videos")
+    parser.add_argument("-s", "--steps", type=int, default=1000, help="number of steps per episode")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of rendering processes")
+    parser.add_argument("--format", choices=["mp4", "gif", "png"], default="mp4", help="video format, or 'png' for a directory of images")
+    parser.add_argument("--size", nargs=2, type=int, default=[640, 480], help="width and height of the frames")
+    args = parser.parse_args()
+
+    if not args.dataset.exists():
+        print(f"error: '{args.dataset}' does not exist", file=sys.stderr)
+        exit(1)
+
+    df = load_dataset(args.dataset)
+    base = df.attrs["base"]
+    original_policy = load_original_policy(df["context"].loc["original"])
+
+    files = render_transfers(
+        [df["context"].loc[name] for name in args.names],
+        args.names,
+        args.modes,
+        original_policy,
+        base,
+        args.outdir,
+        args.outdir / "xml_files",
+        nb_steps=args.steps,
+        nb_workers=args.workers,
+        ext="" if args.format == "png" else f".{args.format}",
+        width=args.size[0],
+        height=args.size[1],
+    )
+    print("\n".join(files))
@@ -0,0 +1,199 @@
+import argparse
+import hashlib
+import json
+import os
+from pathlib import Path
+import pickle
+import shutil
+import sys
+import numpy as np
+
+from dataset import LazyArray, compress, decompress
+from sweep import context_hash
+from work_queue import write_atomic
+
+
+JOB_FILE = "job.json"
+
+# version of the results of `process_context`, bumped when their columns change
+RESULT_FORMAT = 2
+
+
+## Keys
+
+def job_identity(job):
+    """What makes the results of two jobs the same, besides the contexts."""
+    policy_info = job.get("policy_info") or {}
+
+    return dict(
+        generator=job["generator"],
+        policy_repo=policy_info.get("repo_id"),
+        policy_file=policy_info.get("filename"),
+        policy_commit=policy_info.get("commit"),
+        original_context=context_hash(job["original_context"]),
+        base=list(job["base"]),
+        env=job.get("env_id"),
+        nb_episodes=job["nb_episodes"],
+        nb_steps=job.get("nb_steps", 1000),
+        screening=job.get("screening"),
+        backend=job.get("backend", "gym"),
+        adimensional=job.get("adimensional", False),
+        seed=job.get("seed"),
+        env_kwargs=job.get("env_kwargs") or {},
+        result_format=RESULT_FORMAT,
+    )
+
+
+def job_key(job):
+    return hashlib.sha1(json.dumps(job_identity(job), sort_keys=True, default=str).encode()).hexdigest()
+
+
+## Cache
+
+class ResultCache:
+    """Results of `process_context` on disk, reused across runs and sweeps.
+
+    Results are stored by job identity (generator, hence transfer mode, policy and its
+    commit, original context, base, env, its arguments and backend, episodes, steps,
+    screening, recorded fields and seed), then by context hash, compressed with zstd.
+    The rollouts of a context are seeded from the seed and its hash, a cached result is
+    the one a rerun would give. When the cache is larger than max_bytes, the least
+    recently used results are evicted.
+    """
+
+    def __init__(self, path, max_bytes=None):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.size = sum(file.stat().st_size for file in self.entries())
+
+    def entries(self):
+        return self.path.glob("*/*.pkl.zst")
+
+    def entry(self, job, context):
+        return self.path / job_key(job) / f"{context_hash(context)}.pkl.zst"
+
+    def get(self, job, context):
+        """The (index, data) result of a context, or None if it's not cached."""
+        file = self.entry(job, context)
+        try:
+            result = pickle.loads(decompress("zstd", file.read_bytes()))
+            os.utime(file)  # recently used
+        except FileNotFoundError:
+            return None
+        return result
+
+    def put(self, job, context, result):
+        file = self.entry(job, context)
+        if not (file.parent / JOB_FILE).exists():
+            file.parent.mkdir(exist_ok=True)
+            write_atomic(file.parent / JOB_FILE, json.dumps(job_identity(job), indent=1, default=str).encode())
+
+        # trajectories written by the workers to a dataset are read back
+        index, data = result
+        result = index, tuple(np.asarray(x) if isinstance(x, LazyArray) else x for x in data)
+
+        data = compress("zstd", pickle.dumps(result, protocol=5))
+        write_atomic(file, data)
+        self.size += len(data)
+
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            self.evict(self.max_bytes)
+
+    def split(self, job, contexts):
+        """The cached results of contexts, and the contexts left to evaluate."""
+        cached, missing = [], []
+        for context in contexts:
+            result = self.get(job, context)
+            if result is None:
+                missing.append(context)
+            else:
+                cached.append(result)
+        return cached, missing
+
+    def evict(self, max_bytes):
+        """Remove the least recently used results until the cache holds at most max_bytes."""
+        files = []
+        for file in self.entries():
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file))
+
+        self.size = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files):
+            if self.size <= max_bytes:
+                break
+            file.unlink(missing_ok=True)
+            self.size -= size
+
+    def jobs(self):
+        """Identity of the cached jobs, by key."""
+        return {file.parent.name: json.loads(file.read_text()) for file in self.path.glob(f"*/{JOB_FILE}")}
+
+    def invalidate(self, job=None, contexts=None, **identity):
+        """Remove cached results, returns the number of jobs whose results were removed.
+
+        With job, only its results, of the given contexts only if any. Otherwise, the
+        results of all the jobs whose identity matches, e.g. `policy_commit="995505a"`
+        or `generator="similar_transfer_data_gen"`.
+        """
+        if job is not None and contexts is not None:
+            for context in contexts:
+                self.entry(job, context).unlink(missing_ok=True)
+            self.size = sum(file.stat().st_size for file in self.entries())
+            return 1
+
+        keys = [job_key(job)] if job is not None else [
+            key for key, ident in self.jobs().items()
+            if all(str(ident.get(name)) == str(value) for name, value in identity.items())
+        ]
+        for key in keys:
+            shutil.rmtree(self.path / key, ignore_errors=True)
+
+        self.size = sum(file.stat().st_size for file in self.entries())
+        return len(keys)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and invalidate the cache of evaluated contexts.")
+    parser.add_argument("command", choices=["status", "invalidate", "evict"], help="'status' lists the cached jobs, 'invalidate' removes the results of matching jobs, 'evict' shrinks the cache")
+    parser.add_argument("cache", type=Path, help="the cache directory")
+    parser.add_argument("--generator", help="invalidate the results of this generator")
+    parser.add_argument("--commit", help="invalidate the results of this policy commit")
+    parser.add_argument("--all", action="store_true", help="invalidate all the results")
+    parser.add_argument("--max-gb", type=float, default=None, help="size to evict the cache down to")
+    args = parser.parse_args()
+
+    if not args.cache.is_dir():
+        print(f"error: '{args.cache}' is not a cache", file=sys.stderr)
+        exit(1)
+
+    cache = ResultCache(args.cache)
+
+    if args.command == "status":
+        for key, ident in cache.jobs().items():
+            nb_results = len(list((args.cache / key).glob("*.pkl.zst")))
+            print(f"{key[:12]} {nb_results:6d} results  {json.dumps(ident)}")
+        print(f"{cache.size / 1e9:.2f} GB")
+
+    elif args.command == "invalidate":
+        identity = {}
+        if args.generator is not None:
+            identity["generator"] = args.generator
+        if args.commit is not None:
+            identity["policy_commit"] = args.commit
+        if not identity and not args.all:
+            print("error: give --generator, --commit or --all", file=sys.stderr)
+            exit(1)
+
+        print(f"invalidated {cache.invalidate(**identity)} jobs.")
+
+    else:
+        if args.max_gb is None:
+            print("error: give --max-gb", file=sys.stderr)
+            exit(1)
+
+        cache.evict(args.max_gb * 1e9)
+        print(f"{cache.size / 1e9:.2f} GB")
@@ -0,0 +1,190 @@
+import argparse
+from contextlib import contextmanager
+import json
+from pathlib import Path
+import sqlite3
+import sys
+import time
+import pandas as pd
+
+from dataset import SUMMARY_COLUMNS, load_dataset, transfer_mode
+from sweep import context_hash
+
+
+def dataset_modes(path, attrs):
+    """Transfer mode, policy and whether the dataset is from the pre weight update runs.
+
+    The mode and policy are those recorded in the attrs, the file name is only a
+    fallback, see `dataset.transfer_mode`. Converted legacy datasets keep their
+    legacy attrs in attrs["legacy"].
+    """
+    mode, policy = transfer_mode(attrs, path)
+    legacy = "legacy" in attrs or "b" in attrs or "pre_weight_update" in str(path)
+
+    return mode, policy, legacy
+
+
+class ResultIndex:
+    """SQLite index of the evaluated contexts of many datasets.
+
+    Each context is a row of the `contexts` table with its dataset's run, its base
+    values, context hash, the values of its symbols (as `ctx_<symbol>` columns), its
+    summary metrics and where its trajectories are. The `runs` table describes the
+    datasets: mode ('similar' or 'non-similar'), policy ('scaled' or 'naive'),
+    whether it's legacy and the attrs.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+        with self.connect() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS runs (
+                run_id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                mode TEXT,
+                policy TEXT,
+                legacy INTEGER,
+                base TEXT,
+                env TEXT,
+                policy_commit TEXT,
+                nb_eval_episodes INTEGER,
+                attrs TEXT,
+                indexed_at REAL
+            )""")
+            conn.execute(f"""CREATE TABLE IF NOT EXISTS contexts (
+                run_id INTEGER REFERENCES runs(run_id),
+                position INTEGER,
+                name TEXT,
+                context_hash TEXT,
+                b1 REAL, b2 REAL, b3 REAL,
+                {", ".join(f"{c} REAL" for c in SUMMARY_COLUMNS)},
+                PRIMARY KEY (run_id, position)
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS contexts_hash ON contexts (context_hash)")
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def symbol_columns(self, conn):
+        return {row[1] for row in conn.execute("PRAGMA table_info(contexts)") if row[1].startswith("ctx_")}
+
+    def add(self, path, replace=False):
+        """Index all the contexts of a dataset (pickled data frame or dataset directory)."""
+        path = Path(path).absolute()
+
+        with self.connect() as conn:
+            known = conn.execute("SELECT run_id FROM runs WHERE path = ?", (str(path),)).fetchone()
+            if known is not None and not replace:
+                return known[0]
+
+        # the metrics stored in dataset directories, without reading the trajectories
+        df = load_dataset(path, metrics=True)
+        attrs = df.attrs
+        mode, policy, legacy = dataset_modes(path, attrs)
+
+        rows = []
+        for position, (name, row) in enumerate(df.iterrows()):
+            context = row["context"]
+            metrics = {column: row.get(column) for column in SUMMARY_COLUMNS}
+            values = {f"ctx_{sym}": float(v) for sym, v in zip(context.symbols, context.values)}
+            rows.append(dict(
+                position=position, name=name, context_hash=context_hash(context),
+                b1=row["b1"], b2=row["b2"], b3=row["b3"], **metrics, **values,
+            ))
+
+        with self.connect() as conn:
+            if known is not None:
+                conn.execute("DELETE FROM contexts WHERE run_id = ?", (known[0],))
+                conn.execute("DELETE FROM runs WHERE run_id = ?", (known[0],))
+
+            cursor = conn.execute(
+                "INSERT INTO runs (path, mode, policy, legacy, base, env, policy_commit, nb_eval_episodes, attrs, indexed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    str(path), mode, policy, int(legacy),
+                    json.dumps(attrs.get("base")), attrs.get("env"),
+                    attrs.get("policy_info", {}).get("commit"),
+                    attrs.get("nb_eval_episodes"),
+                    json.dumps(attrs, default=str),
+                    time.time(),
+                ),
+            )
+            run_id = cursor.lastrowid
+
+            existing = self.symbol_columns(conn)
+            for column in sorted({c for row in rows for c in row if c.startswith("ctx_")} - existing):
+                conn.execute(f'ALTER TABLE contexts ADD COLUMN "{column}" REAL')
+
+            for row in rows:
+                columns = ", ".join(f'"{c}"' for c in ["run_id", *row.keys()])
+                placeholders = ", ".join("?" * (len(row) + 1))
+                conn.execute(f"INSERT INTO contexts ({columns}) VALUES ({placeholders})", (run_id, *row.values()))
+
+        return run_id
+
+    def query(self, where="1", params=()):
+        """Indexed contexts matching a SQL condition, with their run's description.
+
+        For instance `index.query("ctx_m BETWEEN ? AND ?", (5, 20))`.
+        """
+        with self.connect() as conn:
+            return pd.read_sql_query(
+                f"SELECT runs.path, runs.mode, runs.policy, runs.legacy, contexts.* FROM contexts JOIN runs USING (run_id) WHERE {where}",
+                conn,
+                params=params,
+            )
+
+    def runs(self):
+        with self.connect() as conn:
+            return pd.read_sql_query("SELECT * FROM runs", conn)
+
+
+def load_trajectories(rows, columns=("observations", "actions", "rewards", "infos")):
+    """Trajectories of the rows of a query, read from their datasets."""
+    frames = []
+    for path, group in rows.groupby("path"):
+        df = load_dataset(path)
+        frames.append(df[list(columns)].iloc[group["position"].to_numpy()])
+
+    return pd.concat(frames)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index the contexts of sweep datasets and query them.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    add_parser = subparsers.add_parser("add", help="index datasets")
+    add_parser.add_argument("index", type=Path, help="the index database")
+    add_parser.add_argument("files", nargs="+", type=Path, help="the datasets to index")
+    add_parser.add_argument("--replace", action="store_true", help="index again datasets already indexed")
+
+    query_parser = subparsers.add_parser("query", help="query the indexed contexts")
+    query_parser.add_argument("index", type=Path, help="the index database")
+    query_parser.add_argument("where", nargs="?", default="1", help="SQL condition, e.g. \"ctx_m BETWEEN 5 AND 20 AND policy = 'scaled'\"")
+    query_parser.add_argument("-o", "--output", type=Path, help="write the result to this CSV file instead of printing it")
+
+    args = parser.parse_args()
+
+    index = ResultIndex(args.index)
+
+    if args.command == "add":
+        for file in args.files:
+            if not file.exists():
+                print(f"error: '{file}' does not exist", file=sys.stderr)
+                exit(1)
+
+            print(f"indexing '{file}'...")
+            index.add(file, replace=args.replace)
+        print("done.")
+
+    else:
+        result = index.query(args.where)
+        if args.output is None:
+            print(result.to_string())
+        else:
+            result.to_csv(args.output)
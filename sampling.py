@@ -0,0 +1,86 @@
+import numpy as np
+from scipy.stats import qmc
+
+
+METHODS = ["sobol", "halton", "lhs", "random"]
+
+
+## Samples of the unit hypercube
+
+def sample_unit(nb_samples, nb_dims, method="sobol", scramble=True, seed=None):
+    """(nb_samples, nb_dims) points of [0, 1)^nb_dims from a low-discrepancy sequence.
+
+    Sobol sequences are balanced for powers of 2 samples. The same seed gives the
+    same points.
+    """
+    if method == "sobol":
+        sampler = qmc.Sobol(nb_dims, scramble=scramble, seed=seed)
+        m = int(np.log2(nb_samples))
+        if 2 ** m == nb_samples:
+            return sampler.random_base2(m)
+        return sampler.random(nb_samples)
+    if method == "halton":
+        return qmc.Halton(nb_dims, scramble=scramble, seed=seed).random(nb_samples)
+    if method == "lhs":
+        return qmc.LatinHypercube(nb_dims, scramble=scramble, seed=seed).random(nb_samples)
+    if method == "random":
+        return np.random.default_rng(seed).random((nb_samples, nb_dims))
+    raise ValueError(f"unknown method '{method}', expected one of {METHODS}")
+
+
+def scale_unit(unit, lows, highs, space="geom"):
+    """Map unit samples to [lows, highs], uniformly in log space with "geom"."""
+    lows, highs = np.asarray(lows, dtype=np.float64), np.asarray(highs, dtype=np.float64)
+    if space == "geom":
+        return np.exp(qmc.scale(unit, np.log(lows), np.log(highs)))
+    return qmc.scale(unit, lows, highs)
+
+
+## Contexts
+
+def sample_contexts(original_context, ranges, nb_samples, base=None, space="geom", method="sobol", scramble=True, seed=None):
+    """Contexts sampled over the ranges of some of the symbols of original_context.
+
+    ranges maps symbols to (low, high) factors of their original value, like the
+    `range_1` of the generators. With base, the base symbols are scaled to (similar
+    contexts) and the other symbols are then changed, without base all the symbols
+    are changed. Symbols of a single value are pinned instead of sampled.
+
+    Returns the contexts and the (nb_samples, len(ranges)) array of sampled values.
+    """
+    symbols = list(ranges)
+    originals = np.array([original_context.value(sym) for sym in symbols])
+    lows = originals * np.array([ranges[sym][0] for sym in symbols])
+    highs = originals * np.array([ranges[sym][1] for sym in symbols])
+
+    values = np.tile(lows, (nb_samples, 1))
+    free = lows != highs
+    if np.any(free):
+        unit = sample_unit(nb_samples, int(free.sum()), method, scramble, seed)
+        values[:, free] = scale_unit(unit, lows[free], highs[free], space)
+
+    return make_contexts(original_context, symbols, values, base), values
+
+
+def make_contexts(original_context, symbols, values, base=None):
+    """Contexts with the given (N, len(symbols)) values, like `sample_contexts`."""
+    contexts = []
+    for point in values:
+        sampled = dict(zip(symbols, point))
+        if base is not None:
+            context = original_context.scale_to(base, [sampled.pop(b, original_context.value(b)) for b in base])
+        else:
+            context = original_context
+        if sampled:
+            context = context.change(**sampled)
+        contexts.append(context)
+
+    return contexts
+
+
+def discrepancy(values, lows, highs, space="geom"):
+    """Centered L2 discrepancy of sampled values, lower is a more uniform coverage."""
+    lows, highs = np.asarray(lows, dtype=np.float64), np.asarray(highs, dtype=np.float64)
+    if space == "geom":
+        values, lows, highs = np.log(values), np.log(lows), np.log(highs)
+    return qmc.discrepancy(qmc.scale(values, lows, highs, reverse=True))
@@ -0,0 +1,330 @@
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+from multiprocessing.util import Finalize
+import os
+from pathlib import Path
+import sys
+import time
+import numpy as np
+
+from dataset import LazyArray, SharedWriter, recorded_fields
+from preload import forkserver_context, preloaded_worker, reseed
+from sweep import load_worker
+from telemetry import count_steps, measure
+
+
+THREAD_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS",
+]
+
+Layout = namedtuple("Layout", ["processes", "threads", "pin", "numa"], defaults=[1, False, False])
+
+MAX_ATTEMPTS = 3  # pools a context is evaluated by before it is dropped, when its worker dies
+
+
+## Threads and cores
+
+def limit_threads(nb_threads):
+    """Limit the threads of torch and the BLAS libraries of this process and its children.
+
+    The environment variables only apply to processes started afterwards, torch's
+    intra-op threads are also limited in the current process.
+    """
+    for var in THREAD_VARIABLES:
+        os.environ[var] = str(nb_threads)
+
+    try:
+        import torch
+        torch.set_num_threads(nb_threads)
+    except ImportError:
+        pass
+
+
+def available_cpus():
+    return sorted(os.sched_getaffinity(0))
+
+
+def numa_nodes():
+    """CPUs of each NUMA node, restricted to the CPUs available to this process."""
+    available = set(available_cpus())
+    nodes = []
+
+    for node in sorted(Path("/sys/devices/system/node").glob("node[0-9]*")):
+        cpus = parse_cpulist((node / "cpulist").read_text())
+        cpus = [cpu for cpu in cpus if cpu in available]
+        if cpus:
+            nodes.append(cpus)
+
+    return nodes or [sorted(available)]
+
+
+def parse_cpulist(text):
+    cpus = []
+    for part in text.strip().split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            cpus += range(int(first), int(last) + 1)
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def cpu_sets(layout):
+    """The CPUs each worker is pinned to, spread over the NUMA nodes with layout.numa."""
+    if layout.numa:
+        nodes = numa_nodes()
+        per_node = [[node[i:i + layout.threads] for i in range(0, len(node) - layout.threads + 1, layout.threads)] for node in nodes]
+        # round robin over the nodes, so each node gets the same share of workers
+        sets = [cpus for group in zip(*per_node) for cpus in group]
+        sets += [cpus for group in per_node for cpus in group[min(map(len, per_node)):]]
+    else:
+        cpus = available_cpus()
+        sets = [cpus[i:i + layout.threads] for i in range(0, len(cpus) - layout.threads + 1, layout.threads)]
+
+    if len(sets) < layout.processes:
+        raise ValueError(f"not enough CPUs to pin {layout.processes} workers of {layout.threads} threads")
+
+    return sets[:layout.processes]
+
+
+## Worker processes
+
+_worker = None
+_output = None
+_fields = None
+
+
+def _init_worker(job, nb_threads, cpus_queue, startups, created, output=None):
+    global _worker, _output, _fields
+
+    if cpus_queue is not None:
+        cpus = cpus_queue.get()
+        os.sched_setaffinity(0, cpus)
+        # for a worker started after this one exits, a dead one's are in the queue of the next pool
+        Finalize(None, cpus_queue.put, args=(cpus,), exitpriority=10)
+
+    reseed()
+    limit_threads(nb_threads)
+    _worker = preloaded_worker(job)
+    preloaded = _worker is not None
+    if not preloaded:
+        _worker = load_worker(job)
+    if output is not None:
+        _output = SharedWriter(output)
+        _fields = recorded_fields(job.get("adimensional", False))
+
+    startups.put((os.getpid(), time.time() - created, preloaded))
+
+
+def _evaluate(task):
+    position, context = task
+    index, data, pid, elapsed, policy_time = measure(_worker, context)
+
+    if _output is not None:
+        # only the small columns go back to the parent
+        trajectories = slice(5, 5 + len(_fields))
+        _output.write(position, dict(zip(_fields, data[trajectories])))
+        data = data[:5] + (None,) * len(_fields) + data[trajectories.stop:]
+
+    return position, index, data, pid, elapsed, policy_time
+
+
+def _ready():
+    return os.getpid()
+
+
+class Scheduler:
+    """Pool of worker processes evaluating contexts with a given layout of processes and threads.
+
+    Each worker limits torch and the BLAS libraries to `layout.threads` threads and,
+    with `layout.pin`, is pinned to as many cores (on a single NUMA node with
+    `layout.numa`). The workers are forked from a server which already loaded the
+    job with start_method "forkserver", see `preload.forkserver_context`, or
+    started from scratch with "spawn". The time each worker took to start is in
+    `startup`. When a worker dies, e.g. killed for its memory, the pool is
+    restarted and the contexts it was evaluating are evaluated again, up to
+    MAX_ATTEMPTS times. The evaluations are recorded to telemetry, a `Telemetry`, if
+    given. With output, a `DatasetWriter` from `dataset.preallocate_dataset`, the
+    workers write the trajectories into its files and the results have `LazyArray`
+    handles on them instead. Use it as a context manager.
+    """
+
+    def __init__(self, job, layout, telemetry=None, output=None, start_method="forkserver"):
+        self.job = job
+        self.layout = layout
+        self.telemetry = telemetry
+        self.output = output
+        self.start_method = start_method
+        self.startup = {}
+        self.pool = None
+        self.nb_steps = 0
+        self.elapsed = 0
+        self.busy = {}
+        self.restarts = 0
+
+    def __enter__(self):
+        # inherited by the workers (or their server) before they import torch
+        for var in THREAD_VARIABLES:
+            os.environ[var] = str(self.layout.threads)
+
+        if self.start_method == "forkserver":
+            self.ctx = forkserver_context(self.job)
+        else:
+            self.ctx = multiprocessing.get_context(self.start_method)
+        self.start_pool()
+
+        return self
+
+    def start_pool(self):
+        cpus_queue = None
+        if self.layout.pin:
+            # all the CPU sets, the workers of a broken pool are gone
+            cpus_queue = self.ctx.Queue()
+            for cpus in cpu_sets(self.layout):
+                cpus_queue.put(cpus)
+
+        self.startups = self.ctx.Queue()
+        output = self.output.path if self.output is not None else None
+        initargs = (self.job, self.layout.threads, cpus_queue, self.startups, time.time(), output)
+        self.pool = ProcessPoolExecutor(self.layout.processes, self.ctx, _init_worker, initargs)
+
+        # the workers are started on demand, waits for them to be initialized so
+        # startup is not measured in the throughput
+        pids = {future.result() for future in [self.pool.submit(_ready) for _ in range(self.layout.processes)]}
+        for _ in pids:
+            self.record_startup(*self.startups.get())
+
+    def record_startup(self, pid, seconds, preloaded):
+        self.startup[pid] = seconds
+        if self.telemetry is not None:
+            self.telemetry.record_startup(pid, seconds, preloaded)
+
+    def __exit__(self, *exc):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+
+    def restart_pool(self):
+        self.pool.shutdown(wait=True, cancel_futures=True)
+        self.restarts += 1
+        self.start_pool()
+
+    def map(self, contexts, start=0):
+        """Evaluate the contexts, yielding `(index, data)` as they complete.
+
+        The contexts are at positions start, start + 1, ... of the output. Those
+        still failing after MAX_ATTEMPTS pools died are reported on stderr and skipped.
+        """
+        start_time = time.perf_counter()
+        tasks = enumerate(contexts, start)
+        # position, context and attempts of the context each future evaluates
+        running = {}
+
+        for position, context in tasks:
+            self.submit(running, position, context, 1)
+            # a few contexts ahead of the workers, contexts may be a generator
+            if len(running) >= 2 * self.layout.processes:
+                yield from self.collect(running, start_time)
+
+        while running:
+            yield from self.collect(running, start_time)
+
+    def submit(self, running, position, context, attempts):
+        running[self.pool.submit(_evaluate, (position, context))] = position, context, attempts
+
+    def collect(self, running, start_time):
+        """Results of the contexts completed next, restarts the pool if a worker died."""
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+        broken = []
+
+        for future in done:
+            task = running.pop(future)
+            try:
+                position, index, data, pid, elapsed, policy_time = future.result()
+            except BrokenProcessPool:
+                broken.append(task)
+                continue
+            yield self.record(position, index, data, pid, elapsed, policy_time, start_time)
+
+        if broken:
+            # the other contexts of the dead pool are lost with it
+            broken += list(running.values())
+            running.clear()
+            self.restart_pool()
+            for position, context, attempts in broken:
+                if attempts < MAX_ATTEMPTS:
+                    self.submit(running, position, context, attempts + 1)
+                else:
+                    print(f"warning: skipped the context at {position}, its worker died {attempts} times", file=sys.stderr)
+
+    def record(self, position, index, data, pid, elapsed, policy_time, start_time):
+        # workers started on demand
+        while not self.startups.empty():
+            self.record_startup(*self.startups.get())
+
+        if self.output is not None:
+            fields = recorded_fields(self.job.get("adimensional", False))
+            trajectories = tuple(LazyArray(self.output.fields[name], position) for name in fields)
+            data = data[:5] + trajectories + data[5 + len(fields):]
+        self.nb_steps += count_steps(data)
+        self.busy[pid] = self.busy.get(pid, 0) + elapsed
+        self.elapsed = time.perf_counter() - start_time
+        if self.telemetry is not None:
+            self.telemetry.record(index, data, elapsed, pid, policy_time)
+        return index, data
+
+    def run(self, contexts, start=0):
+        """Start the workers, evaluate the contexts like `map` and stop the workers."""
+        with self:
+            yield from self.map(contexts, start)
+
+    @property
+    def steps_per_second(self):
+        return self.nb_steps / self.elapsed if self.elapsed else 0
+
+    def report(self):
+        utilization = np.mean(list(self.busy.values())) / self.elapsed if self.elapsed else 0
+        startup = max(self.startup.values()) if self.startup else 0
+        return (
+            f"{self.layout.processes} processes x {self.layout.threads} threads"
+            f"{' pinned' if self.layout.pin else ''}{' (NUMA)' if self.layout.numa else ''}: "
+            f"{self.steps_per_second:.0f} env steps/s, {utilization:.0%} worker utilization, "
+            f"started in {startup:.1f} s"
+            f"{f', restarted {self.restarts} times' if self.restarts else ''}"
+        )
+
+
+## Calibration
+
+def candidate_layouts(nb_cpus=None, threads=(1, 2, 4), pin=False, numa=False):
+    nb_cpus = nb_cpus or len(available_cpus())
+    return [Layout(nb_cpus // t, t, pin, numa) for t in threads if nb_cpus // t >= 1]
+
+
+def calibrate(job, contexts, layouts=None, contexts_per_process=2):
+    """Measure the env steps per second of each layout on a sample of the contexts.
+
+    Returns the fastest layout and the measures of all of them as (layout, steps/s).
+    The workers are spawned, a forkserver would keep the BLAS threads of the first
+    layout for all of them.
+    """
+    layouts = layouts or candidate_layouts()
+    measures = []
+
+    for layout in layouts:
+        # spread over the sweep, the cost of a context depends on where it is
+        nb_samples = min(len(contexts), layout.processes * contexts_per_process)
+        sample = [contexts[i] for i in np.linspace(0, len(contexts) - 1, nb_samples).astype(int)]
+        with Scheduler(job, layout, start_method="spawn") as scheduler:
+            for _ in scheduler.map(sample):
+                pass
+            print("calibration", scheduler.report())
+            measures.append((layout, scheduler.steps_per_second))
+
+    best, _ = max(measures, key=lambda measure: measure[1])
+
+    return best, measures
@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 import numpy as np
 import pandas as pd
@@ -8,7 +9,19 @@ from huggingface_sb3 import load_from_hub
 from pipoli.core import DimensionalPolicy, Dimension, Context
 from pipoli.sources.sb3 import SB3Policy
 
-from make_cheetah import make_cheetah, make_cheetah_xml
+from make_cheetah import make_cheetah, make_cheetah_xml, make_cheetahs
+from sweep import context_seed, make_job
+from work_queue import open_queue, wait_results
+from scheduler import Layout, Scheduler, available_cpus, calibrate
+from dataset import finish_dataset, preallocate_dataset, recorded_fields, write_dataset
+from estimate_sweep import check_sweep, format_estimate, measure_sweep
+from telemetry import Telemetry, timed_action
+from result_cache import ResultCache
+from sampling import sample_contexts
+from active_learning import ActiveLearner
+from fidelity import multi_fidelity
+from sketch import context_sketches
+from batch_context import transform_scales
 
 
 BASE_DIMENSIONS = [
@@ -18,13 +31,20 @@ BASE_DIMENSIONS = [
 ]
 Unit = Dimension([0, 0, 0])
 
+OBS_DIMS = [L] + [Unit] * 7 + [L/T] * 2 + [1/T] * 7
+ACT_DIMS = [M*L**2/T**2] * 6
 
-def load_original_policy():
+
+def load_model():
     halfcheetah_v5_tqc_expert =  load_from_hub(
         repo_id="farama-minari/HalfCheetah-v5-TQC-expert",
         filename="halfcheetah-v5-TQC-expert.zip",
     )
-    model = TQC.load(halfcheetah_v5_tqc_expert, device="cpu")
+    return TQC.load(halfcheetah_v5_tqc_expert, device="cpu")
+
+
+def load_original_policy(original_context, model=None):
+    model = model or load_model()
 
     sb3_policy = SB3Policy(
         model,
@@ -36,17 +56,17 @@ def load_original_policy():
     original_policy = DimensionalPolicy(
         sb3_policy,
         original_context,
-        obs_dims=[L] + [Unit] * 7 + [L/T] * 2 + [1/T] * 7,
-        act_dims=[M*L**2/T**2] * 6
+        obs_dims=OBS_DIMS,
+        act_dims=ACT_DIMS
     )
 
     return original_policy
 
 
-def evaluate_policy(context, xml_file, base, nb_episodes, original_policy):
+def evaluate_policy(context, xml_file, base, nb_episodes, original_policy, nb_steps=1000, adimensional=False, seed=None,
+                    env_kwargs=None):
     policy = original_policy.to_scaled(context, base)
 
-    nb_steps = 1000
     forward_weight = context.value("forward_reward_weight")
     ctrl_weight = context.value("ctrl_cost_weight")
     env = gym.make(
@@ -54,6 +74,8 @@ def evaluate_policy(context, xml_file, base, nb_episodes, original_policy):
         xml_file=xml_file,
         forward_reward_weight=forward_weight,
         ctrl_cost_weight=ctrl_weight,
+        max_episode_steps=nb_steps,
+        **(env_kwargs or {}),
     )
 
     observations = np.zeros((nb_episodes, nb_steps, 17))
@@ -61,18 +83,28 @@ def evaluate_policy(context, xml_file, base, nb_episodes, original_policy):
     rewards = np.zeros((nb_episodes, nb_steps))
     infos = np.full((nb_episodes, nb_steps), None)
 
+    if adimensional:
+        # what the transforms of the context divide by, the scaled policy's own inputs and outputs
+        obs_scales, act_scales = (transform_scales([context], dims, base)[0] for dims in (OBS_DIMS, ACT_DIMS))
+        adim_observations = np.zeros((nb_episodes, nb_steps, 17))
+        adim_actions = np.zeros((nb_episodes, nb_steps, 6))
+
     for ep in range(nb_episodes):
         # print("ep", ep)
         trunc = False
         step = 0
     
-        obs, info = env.reset()
+        # seeded once, the following episodes continue the env's RNG
+        obs, info = env.reset(seed=seed if ep == 0 else None)
 
         while not trunc:
-            act = policy.action(obs)
+            act = timed_action(policy, obs)
 
             observations[ep, step] = obs
             actions[ep, step] = act
+            if adimensional:
+                np.divide(obs, obs_scales, out=adim_observations[ep, step])
+                np.divide(act, act_scales, out=adim_actions[ep, step])
 
             obs, rew, _, trunc, info = env.step(act)
 
@@ -83,10 +115,13 @@ def evaluate_policy(context, xml_file, base, nb_episodes, original_policy):
 
     env.close()
 
+    if adimensional:
+        return observations, actions, rewards, infos, adim_observations, adim_actions
     return observations, actions, rewards, infos
 
 
-def process_context(context, base, nb_episodes, xml_dir, original_policy):
+def process_context(context, base, nb_episodes, xml_dir, original_policy, nb_steps=1000, screening=None, adimensional=False,
+                    seed=0, env_kwargs=None):
     b1 = context.value(base[0])
     b2 = context.value(base[1])
     b3 = context.value(base[2])
@@ -96,9 +131,54 @@ def process_context(context, base, nb_episodes, xml_dir, original_policy):
     xml_file = Path(xml_dir) / (index + ".xml")
     xml_file.write_text(xml)
 
-    evaluation = evaluate_policy(context, str(xml_file.absolute()), base, nb_episodes, original_policy)
+    def evaluate(nb_episodes, nb_steps):
+        return evaluate_policy(
+            context, str(xml_file.absolute()), base, nb_episodes, original_policy, nb_steps, adimensional,
+            context_seed(seed, context), env_kwargs,
+        )
+
+    evaluation, fidelity = multi_fidelity(evaluate, nb_episodes, nb_steps, screening)
+    sketches = context_sketches(context, base, evaluation[0], evaluation[1], OBS_DIMS, ACT_DIMS)
     
-    return index, (context, xml, b1, b2, b3) + evaluation
+    return index, (context, xml, b1, b2, b3) + evaluation + (fidelity,) + sketches
+
+
+def process_contexts_batched(contexts, base, nb_episodes, xml_dir, original_context, nb_steps=1000, backend="mjx",
+                             batch_size=256, adimensional=False, seed=0):
+    """Like `process_context` for all the contexts, simulated by batches with MJX or threads.
+
+    The model predicts the actions of a whole batch at once, see `mjx_backend.transferred_policy`.
+    """
+    from mjx_backend import batched_rollouts, transferred_policy
+    from batch_stepping import threaded_rollouts
+
+    rollouts = batched_rollouts if backend == "mjx" else threaded_rollouts
+    model = load_model()
+
+    def predict(observations):
+        return model.predict(observations, deterministic=True)[0]
+
+    for start in range(0, len(contexts), batch_size):
+        batch = contexts[start:start + batch_size]
+        policy = transferred_policy(predict, original_context, batch, base, OBS_DIMS, ACT_DIMS)
+        evaluations = rollouts(batch, policy, nb_episodes, nb_steps, [context_seed(seed, context) for context in batch])
+        if adimensional:
+            obs_scales, act_scales = (transform_scales(batch, dims, base) for dims in (OBS_DIMS, ACT_DIMS))
+            evaluations = [
+                evaluation + (evaluation[0] / obs, evaluation[1] / act)
+                for evaluation, obs, act in zip(evaluations, obs_scales, act_scales)
+            ]
+
+        for context, xml, evaluation in zip(batch, make_cheetahs(batch), evaluations):
+            b1 = context.value(base[0])
+            b2 = context.value(base[1])
+            b3 = context.value(base[2])
+            index = f"cheetah-{base[0]}-{base[1]}-{base[2]}_{b1:.3e}_{b2:.3e}_{b3:.3e}"
+
+            (Path(xml_dir) / (index + ".xml")).write_text(xml)
+            sketches = context_sketches(context, base, evaluation[0], evaluation[1], OBS_DIMS, ACT_DIMS)
+
+            yield index, (context, xml, b1, b2, b3) + evaluation + ("full",) + sketches
 
 
 if __name__ == "__main__":
@@ -119,7 +199,70 @@ if __name__ == "__main__":
     num_2 = 50
     num_3 = 1
 
+    # set to e.g. dict(nb_samples=1024, method="sobol", seed=0) to sample the contexts
+    # quasi-randomly over the ranges instead of the num_1 x num_2 x num_3 grid, see
+    # `sampling.sample_contexts`
+    sampling = None
+
+    # set to e.g. dict(max_contexts=256, target_error=50) to evaluate the contexts where a
+    # surrogate of the transfer is the least certain instead, it is saved next to the
+    # data, see `active_learning.ActiveLearner`
+    active_learning = None
+
     nb_eval_episodes = 10
+    nb_steps = 1000
+
+    # the rollouts of each context are seeded with this seed and the context's hash, so
+    # a context gives the same result in every sweep, and extra arguments of gym.make
+    # (e.g. dict(reset_noise_scale=0.05)) for the gym backend
+    seed = 0
+    env_kwargs = {}
+
+    # also record the observations and actions adimensionalized by each context, as the
+    # scaled policy sees them, in adim_observations and adim_actions, see `evaluate_policy`
+    adimensional = False
+
+    # set to e.g. dict(nb_episodes=2, nb_steps=200, min_forward=0.0) to screen the
+    # contexts with short rollouts first, those failing the screening aren't evaluated
+    # further and keep their rollout padded with NaN, see `fidelity.multi_fidelity`
+    screening = None
+
+    # set to a '.sqlite' file or a directory on a shared filesystem to distribute the
+    # contexts to workers started with `python3 work_queue.py work QUEUE`
+    queue_path = None
+
+    # "mjx" simulates the contexts by batches of batch_size in a single process with MJX
+    # (needs jax and mujoco-mjx) instead of one gym env per context, see
+    # `mjx_backend.BatchedCheetah`, "threads" steps the MuJoCo instances of a batch with
+    # all the cores, see `batch_stepping.SteppingEngine`, the screening is not supported
+    backend = "gym"
+    batch_size = 256
+
+    # set to a Layout(processes, threads, pin, numa) to evaluate the contexts in parallel
+    # on this node, or to "auto" to pick the fastest layout from a calibration run
+    layout = None
+
+    # compression of the dataset directory written at the end, one of dataset.CODECS,
+    # or "pickle" to write a single '.pkl.gz' data frame, with "none" and a layout the
+    # workers write the trajectories straight into the dataset
+    codec = "zstd"
+    level = 3
+
+    # number of contexts evaluated first to estimate the duration, memory and output
+    # size of the sweep, which stops if it won't fit (0 to skip), dry_run only estimates
+    preflight_samples = 3
+    dry_run = False
+
+    # JSON-lines snapshots of the sweep's throughput, appended to a file or sent to
+    # "udp://host:port" every telemetry_interval seconds, see `python3 telemetry.py tail`
+    telemetry_target = ROOT / "telemetry.jsonl"
+    telemetry_interval = 10
+
+    # results of contexts already evaluated, by this or previous runs with the same
+    # policy, env, episodes and seed, are read from this directory instead (None to
+    # disable it), the least recently used are evicted above cache_max_bytes
+    cache_dir = ROOT / "cache"
+    cache_max_bytes = 50e9
 
     #
     # Other metadata
@@ -128,6 +271,9 @@ if __name__ == "__main__":
     actions_shape = "(nb_episodes, nb_steps, 6)"
     rewards_shape = "(nb_episodes, nb_steps)"
     infos_shape = "(nb_episodes, nb_steps)"
+    # dimensional then adimensional, quantiles then histogram counts, see sketch.py
+    observation_sketch_shape = "(2, 65, 17)"
+    action_sketch_shape = "(2, 65, 6)"
 
     policy_info = {
         "repo_id": "farama-minari/HalfCheetah-v5-TQC-expert",
@@ -180,7 +326,7 @@ the policy was scaled (scaled transfer)"""
     original_cheetah_file = make_cheetah_xml(original_context, "original", outdir=XML_FILES)
     original_cheetah_xml = Path(original_cheetah_file).read_text()
 
-    original_policy = load_original_policy()
+    original_policy = load_original_policy(original_context)
 
     #
     # Make all contexts
@@ -190,18 +336,39 @@ the policy was scaled (scaled transfer)"""
     b2s = rangespace(*range_2, num=num_2) * original_context.value(base[1])
     b3s = rangespace(*range_3, num=num_3) * original_context.value(base[2])
 
-    all_contexts = []
-
-    for b1 in b1s:
-        for b2 in b2s:
-            for b3 in b3s:
-                context = original_context.scale_to(base, [b1, b2, b3])
-                all_contexts.append(context)
+    if backend != "gym":
+        # the batched backends simulate all the contexts in this process, without screening
+        unsupported = [name for name, value in [("screening", screening), ("queue_path", queue_path),
+                                                ("layout", layout), ("active_learning", active_learning),
+                                                ("env_kwargs", env_kwargs or None)] if value is not None]
+        if unsupported:
+            print(f"error: the {backend} backend doesn't support {', '.join(unsupported)}, disable it or use the gym backend")
+            exit(1)
+
+    learner = None
+    if active_learning is not None and screening is not None:
+        print("error: active learning needs fully evaluated contexts, disable the screening")
+        exit(1)
+    elif active_learning is not None:
+        ranges = dict(zip(base, [range_1, range_2, range_3]))
+        learner = ActiveLearner(original_context, ranges, base=base, **active_learning)
+        all_contexts = []
+    elif sampling is not None:
+        ranges = dict(zip(base, [range_1, range_2, range_3]))
+        all_contexts, _ = sample_contexts(original_context, ranges, base=base, space=space, **sampling)
+    else:
+        all_contexts = []
+
+        for b1 in b1s:
+            for b2 in b2s:
+                for b3 in b3s:
+                    context = original_context.scale_to(base, [b1, b2, b3])
+                    all_contexts.append(context)
     
     #
     # Evaluation of transfer on all contexts
     #
-    df = pd.DataFrame(columns=["context", "xml", "b1", "b2", "b3", "observations", "actions", "rewards", "infos"])
+    df = pd.DataFrame(columns=["context", "xml", "b1", "b2", "b3"] + recorded_fields(adimensional) + ["fidelity", "observation_sketch", "action_sketch"])
     df.attrs["base"] = base
     df.attrs["space"] = space
     df.attrs["range_1"] = range_1
@@ -210,40 +377,143 @@ the policy was scaled (scaled transfer)"""
     df.attrs["num_1"] = num_1
     df.attrs["num_2"] = num_2
     df.attrs["num_3"] = num_3
+    df.attrs["sampling"] = sampling
+    df.attrs["active_learning"] = active_learning
     df.attrs["nb_eval_episodes"] = nb_eval_episodes
+    df.attrs["nb_steps"] = nb_steps
+    df.attrs["adimensional"] = adimensional
+    if adimensional:
+        # what adim_observations and adim_actions were adimensionalized by
+        df.attrs["adimensional_by"] = "each context"
+    df.attrs["screening"] = screening
+    df.attrs["backend"] = backend
     df.attrs["observations_shape"] = observations_shape
     df.attrs["actions_shape"] = actions_shape
     df.attrs["rewards_shape"] = rewards_shape
     df.attrs["infos_shape"] = infos_shape
+    df.attrs["observation_sketch_shape"] = observation_sketch_shape
+    df.attrs["action_sketch_shape"] = action_sketch_shape
     df.attrs["policy_info"] = policy_info
     df.attrs["env"] = env_id
     df.attrs["comment"] = comment
 
+    job = make_job(Path(__file__).stem, original_context, base, nb_eval_episodes, XML_FILES, policy_info, env_id, nb_steps, screening, backend, adimensional,
+                   seed, env_kwargs)
+
+    cache = None
+    cached = []
+    if cache_dir is not None:
+        cache = ResultCache(cache_dir, cache_max_bytes)
+        cached, all_contexts = cache.split(job, all_contexts)
+        print(f"{len(cached)} contexts found in the cache")
+
+    preflight = {}
+    if preflight_samples and all_contexts:
+        print("Estimating the sweep...")
+        estimate, preflight = measure_sweep(job, all_contexts, preflight_samples, codec, level)
+        print(format_estimate(estimate))
+
+        nb_workers = len(available_cpus()) if layout == "auto" else layout.processes if layout is not None else 1
+        problems = check_sweep(estimate, nb_workers, DATA)
+        for problem in problems:
+            print(f"error: the sweep {problem}")
+        if problems or dry_run:
+            exit(1 if problems else 0)
+
+        # the contexts evaluated by the estimate are kept
+        all_contexts = [c for i, c in enumerate(all_contexts) if i not in preflight]
+
     from tqdm import tqdm
-    import time
 
     print("Similar scaled transfer data generation\n")
 
     print("Original context evaluation...")
-    pbar = tqdm(total=len(all_contexts) + 1)
+    pbar = tqdm(total=len(cached) + len(preflight) + len(all_contexts) + 1)
 
-    _, data = process_context(original_context, base, nb_eval_episodes, XML_FILES, original_policy)
+    _, data = process_context(original_context, base, nb_eval_episodes, XML_FILES, original_policy, nb_steps, adimensional=adimensional,
+                              seed=seed, env_kwargs=env_kwargs)
     df.loc["original"] = data
     pbar.update()
+
+    for index, data in cached:
+        df.loc[index] = data
+        pbar.update()
+
+    for index, data in preflight.values():
+        df.loc[index] = data
+        if cache is not None:
+            cache.put(job, data[0], (index, data))
+        pbar.update()
     
     def worker(c):
-        return process_context(c, base, nb_eval_episodes, XML_FILES, original_policy)
+        return process_context(c, base, nb_eval_episodes, XML_FILES, original_policy, nb_steps, screening, adimensional, seed, env_kwargs)
+
+    scheduler = None
+    output = None
+    telemetry = Telemetry(telemetry_target, len(all_contexts), telemetry_interval)
 
     print("Evaluating other contexts...")
-    for index, data in map(worker, all_contexts):
+    if learner is not None:
+        if not isinstance(layout, Layout):
+            layout = Layout(len(available_cpus()) if layout == "auto" else 1)
+        scheduler = Scheduler(job, layout, telemetry)
+        telemetry.nb_contexts = learner.max_contexts
+        pbar.total = len(cached) + learner.max_contexts + 1
+        results = learner.run(scheduler, df.index)
+    elif backend in ("mjx", "threads"):
+        contexts = process_contexts_batched(all_contexts, base, nb_eval_episodes, XML_FILES, original_context, nb_steps, backend, batch_size, adimensional,
+                                            seed)
+        results = telemetry.follow(contexts)
+    elif queue_path is not None:
+        queue = open_queue(queue_path)
+        try:
+            queue.submit(job, all_contexts)
+        except ValueError as error:
+            print(f"error: {error}")
+            exit(1)
+        telemetry.queue = queue
+        results = telemetry.follow(wait_results(queue, len(all_contexts)))
+    elif layout is not None:
+        if layout == "auto":
+            layout, _ = calibrate(job, all_contexts)
+        if codec == "none":
+            # the workers write the trajectories straight into the dataset
+            output = preallocate_dataset(df, DATA / f".sweep-{os.getpid()}.ds", len(df) + len(all_contexts))
+        scheduler = Scheduler(job, layout, telemetry, output)
+        results = scheduler.run(all_contexts, start=len(df))
+    else:
+        results = telemetry.track(worker, all_contexts)
+
+    for index, data in results:
         df.loc[index] = data
+        # the trajectories written by the workers would be read back to be cached
+        if cache is not None and output is None:
+            cache.put(job, data[0], (index, data))
+        pbar.set_postfix_str(telemetry.summary(), refresh=False)
         pbar.update()
 
     pbar.close()
+    telemetry.close()
+
+    if scheduler is not None:
+        print(scheduler.report())
 # stop = time.time()
 # print(stop-start, "s")
     
+    name = f"data-similar-{str(base)[1:-1].replace(', ', '-')}-{space}-{range_1}-{range_2}-{range_3}-{num_1}-{num_2}-{num_3}"
+    if learner is not None:
+        name += f"-active-{len(learner.X)}"
+        learner.surrogate.save(DATA / f"{name}-surrogate.pkl")
+    elif sampling is not None:
+        name += f"-{sampling.get('method', 'sobol')}-{sampling['nb_samples']}"
     memory = df.memory_usage(deep=True).sum()
-    print(f"Pickling {memory / 1e9:.3f} GB of data...")
-    df.to_pickle(DATA / f"data-similar-{str(base)[1:-1].replace(', ', '-')}-{space}-{range_1}-{range_2}-{range_3}-{num_1}-{num_2}-{num_3}.pkl.gz")
+    if output is not None:
+        print("Finishing the dataset written by the workers...")
+        finish_dataset(output, df, DATA / f"{name}.ds")
+    elif codec == "pickle":
+        print(f"Pickling {memory / 1e9:.3f} GB of data...")
+        df.to_pickle(DATA / f"{name}.pkl.gz")
+    else:
+        print(f"Writing {memory / 1e9:.3f} GB of data with {codec}...")
+        write_dataset(df, DATA / f"{name}.ds", codec=codec, level=level)
     
\ No newline at end of file
@@ -0,0 +1,155 @@
+import numpy as np
+
+from batch_context import transform_scales
+from dataset import LazyArray
+
+
+# probabilities of the stored quantiles, the first and last are the min and max
+QUANTILES = np.linspace(0, 1, 33)
+NB_BINS = 32
+
+
+## Streaming sketch
+
+def compress(values, weights, size):
+    """size values of equal weight at evenly spaced cumulative weights of the weighted values."""
+    order = np.argsort(values)
+    values, weights = values[order], weights[order]
+    ranks = np.cumsum(weights) - weights / 2
+    targets = (np.arange(size) + 0.5) / size * weights.sum()
+    return np.interp(targets, ranks, values)
+
+
+class Sketch:
+    """Fixed size summary of the distribution of each column of a stream of samples.
+
+    Samples are added by blocks of (n, nb_dims) rows, e.g. the steps of an episode.
+    Each column is kept as size points of equal weight, the quantiles of all the
+    samples added so far at evenly spaced ranks, with the exact count, min and max.
+    A block is merged with the points, which are then recompressed, so the memory
+    doesn't grow with the stream and the rank error of the quantiles is about
+    1/size. NaN samples, like the padded steps of screened contexts, are ignored.
+    """
+
+    def __init__(self, nb_dims, size=256):
+        self.size = size
+        self.points = np.full((size, nb_dims), np.nan)
+        self.count = np.zeros(nb_dims)
+        self.min = np.full(nb_dims, np.inf)
+        self.max = np.full(nb_dims, -np.inf)
+
+    def add(self, samples, weight=None):
+        samples = np.asarray(samples, dtype=np.float64).reshape(-1, self.points.shape[1])
+        weight = np.ones(len(samples)) if weight is None else weight
+
+        for dim in range(self.points.shape[1]):
+            column = samples[:, dim]
+            valid = ~np.isnan(column)
+            if not valid.any():
+                continue
+
+            column, column_weight = column[valid], weight[valid]
+            values = np.concatenate([self.points[:, dim], column]) if self.count[dim] else column
+            weights = np.concatenate([np.full(self.size, self.count[dim] / self.size), column_weight]) if self.count[dim] else column_weight
+
+            self.points[:, dim] = compress(values, weights, self.size)
+            self.count[dim] += column_weight.sum()
+            self.min[dim] = min(self.min[dim], column.min())
+            self.max[dim] = max(self.max[dim], column.max())
+
+        return self
+
+    def merge(self, other):
+        """Add the samples summarized by another sketch of the same size, e.g. of another context."""
+        for dim in range(self.points.shape[1]):
+            if other.count[dim]:
+                sketch = Sketch(1, self.size)
+                sketch.points[:, 0], sketch.count[0] = self.points[:, dim], self.count[dim]
+                sketch.add(other.points[:, dim], np.full(self.size, other.count[dim] / self.size))
+                self.points[:, dim], self.count[dim] = sketch.points[:, 0], sketch.count[0]
+                self.min[dim] = min(self.min[dim], other.min[dim])
+                self.max[dim] = max(self.max[dim], other.max[dim])
+        return self
+
+    def knots(self, dim):
+        # the cumulative distribution goes through the points, from the min to the max
+        ranks = np.concatenate([[0], (np.arange(self.size) + 0.5) / self.size, [1]])
+        return ranks, np.concatenate([[self.min[dim]], self.points[:, dim], [self.max[dim]]])
+
+    def quantiles(self, probabilities=QUANTILES):
+        """(len(probabilities), nb_dims) quantiles of each column."""
+        result = np.full((len(probabilities), self.points.shape[1]), np.nan)
+        for dim in np.flatnonzero(self.count):
+            result[:, dim] = np.interp(probabilities, *self.knots(dim))
+        return result
+
+    def histogram(self, nb_bins=NB_BINS):
+        """(nb_bins, nb_dims) counts of each column in nb_bins equal bins from its min to its max."""
+        result = np.full((nb_bins, self.points.shape[1]), np.nan)
+        for dim in np.flatnonzero(self.count):
+            ranks, values = self.knots(dim)
+            edges = np.linspace(self.min[dim], self.max[dim], nb_bins + 1)
+            # np.interp needs increasing values, equal ones share the rank of the last
+            values, last = np.unique(values[::-1], return_index=True)
+            cdf = np.interp(edges, values, ranks[::-1][last]) if len(values) > 1 else np.r_[0, np.ones(nb_bins)]
+            result[:, dim] = self.count[dim] * np.diff(cdf)
+        return result
+
+
+## Per context sketches
+
+def sketch_array(sketch, scales):
+    """(2, len(QUANTILES) + NB_BINS, nb_dims) array of a sketch, dimensional then adimensional.
+
+    Each has the QUANTILES of each dimension followed by its histogram in NB_BINS
+    bins from its min to its max. scales are what adimensionalizing divides the
+    samples by, positive, so the adimensional quantiles are the dimensional ones
+    divided by them and the histograms are the same.
+    """
+    quantiles, histogram = sketch.quantiles(), sketch.histogram()
+    return np.stack([
+        np.concatenate([quantiles, histogram]),
+        np.concatenate([quantiles / scales, histogram]),
+    ])
+
+
+def context_sketches(context, base, observations, actions, obs_dims, act_dims, size=256):
+    """Sketches of the observations and actions of a context, streamed episode by episode."""
+    sketches = []
+    for trajectory, dims in [(observations, obs_dims), (actions, act_dims)]:
+        trajectory = np.asarray(trajectory)
+        sketch = Sketch(trajectory.shape[-1], size)
+        for episode in trajectory:
+            sketch.add(episode)
+        sketches.append(sketch_array(sketch, transform_scales([context], dims, base)[0]))
+
+    return tuple(sketches)
+
+
+## Reading
+
+def stack_sketches(column):
+    """(N, 2, len(QUANTILES) + NB_BINS, nb_dims) array of a sketch column of a dataset.
+
+    Uncompressed datasets are read from the memory-mapped file at once.
+    """
+    cells = list(column)
+    if cells and all(isinstance(cell, LazyArray) for cell in cells):
+        field = cells[0].field
+        if field.codec == "none" and all(cell.field is field for cell in cells):
+            return np.asarray(field.data[[cell.position for cell in cells]])
+
+    return np.stack([np.asarray(cell) for cell in cells])
+
+
+def quantiles(sketches, adim=False):
+    """(..., len(QUANTILES), nb_dims) quantiles of sketch arrays."""
+    return np.asarray(sketches)[..., int(adim), :len(QUANTILES), :]
+
+
+def histograms(sketches, adim=False):
+    """(..., NB_BINS, nb_dims) counts and (..., NB_BINS + 1, nb_dims) bin edges of sketch arrays."""
+    sketches = np.asarray(sketches)[..., int(adim), :, :]
+    low, high = sketches[..., :1, :], sketches[..., len(QUANTILES) - 1:len(QUANTILES), :]
+    edges = low + (high - low) * np.linspace(0, 1, NB_BINS + 1)[:, None]
+    return sketches[..., len(QUANTILES):, :], edges
@@ -0,0 +1,67 @@
+import hashlib
+import importlib
+from pathlib import Path
+import numpy as np
+
+
+## Jobs shared with worker processes
+
+def make_job(generator, original_context, base, nb_episodes, xml_dir, policy_info=None, env_id=None, nb_steps=1000,
+             screening=None, backend="gym", adimensional=False, seed=0, env_kwargs=None):
+    """Everything a worker process needs to evaluate contexts like the generator does.
+
+    generator is the module name of a data generation script (e.g.
+    "similar_transfer_data_gen"), its `load_original_policy` and `process_context`
+    are used by the workers. xml_dir must be reachable by all the workers.
+    policy_info, env_id and the simulation backend identify the results, for the
+    result cache. nb_steps and screening are those of `fidelity.multi_fidelity`,
+    adimensional also records the adimensional observations and actions. The rollouts
+    of each context are seeded with `context_seed(seed, context)`, env_kwargs are the
+    extra arguments of `gym.make`.
+    """
+    return dict(
+        generator=generator,
+        original_context=original_context,
+        base=list(base),
+        nb_episodes=nb_episodes,
+        xml_dir=str(Path(xml_dir).absolute()),
+        policy_info=policy_info,
+        env_id=env_id,
+        nb_steps=nb_steps,
+        screening=screening,
+        backend=backend,
+        adimensional=adimensional,
+        seed=seed,
+        env_kwargs=dict(env_kwargs or {}),
+    )
+
+
+def load_worker(job):
+    """Load the original policy once and return a function evaluating one context."""
+    module = importlib.import_module(job["generator"])
+    original_policy = module.load_original_policy(job["original_context"])
+
+    def worker(context):
+        return module.process_context(
+            context, job["base"], job["nb_episodes"], job["xml_dir"], original_policy,
+            job.get("nb_steps", 1000), job.get("screening"), job.get("adimensional", False),
+            job.get("seed", 0), job.get("env_kwargs"),
+        )
+
+    return worker
+
+
+## Context identity
+
+def context_hash(context):
+    """Hash of the symbols and values of a context, the same across runs and machines."""
+    h = hashlib.sha1()
+    h.update(" ".join(context.symbols).encode())
+    h.update(np.asarray(context.values, dtype=np.float64).tobytes())
+
+    return h.hexdigest()
+
+
+def context_seed(seed, context):
+    """Seed of the rollouts of a context, the same in every sweep with the same seed."""
+    return int(hashlib.sha1(f"{seed}:{context_hash(context)}".encode()).hexdigest()[:8], 16)
@@ -0,0 +1,279 @@
+import argparse
+from collections import deque
+import heapq
+import json
+import os
+from pathlib import Path
+import socket
+import sys
+import threading
+import time
+import numpy as np
+
+
+## Measures taken in the workers
+
+_policy_seconds = 0.0
+_policy_calls = 0
+
+
+def timed_action(policy, obs):
+    """`policy.action(obs)`, timed for the policy latency of the telemetry."""
+    global _policy_seconds, _policy_calls
+
+    start = time.perf_counter()
+    act = policy.action(obs)
+    _policy_seconds += time.perf_counter() - start
+    _policy_calls += 1
+
+    return act
+
+
+def take_policy_time():
+    """Time spent in the policy and number of actions since the last call."""
+    global _policy_seconds, _policy_calls
+
+    measure = _policy_seconds, _policy_calls
+    _policy_seconds, _policy_calls = 0.0, 0
+
+    return measure
+
+
+def measure(worker, context):
+    """Evaluate a context, returns (index, data, pid, elapsed seconds, policy time)."""
+    take_policy_time()
+    start = time.perf_counter()
+    index, data = worker(context)
+    elapsed = time.perf_counter() - start
+
+    return index, data, os.getpid(), elapsed, take_policy_time()
+
+
+def count_steps(data):
+    # the rewards are (nb_episodes, nb_steps), NaN past the steps of screened out contexts
+    return np.count_nonzero(~np.isnan(data[7]))
+
+
+## Snapshots
+
+class Telemetry:
+    """Throughput of a sweep, written as JSON-lines snapshots every interval seconds.
+
+    target is a file, appended to, or "udp://host:port" to send the snapshots as
+    datagrams, or None to only keep the statistics. Each snapshot has the progress,
+    the env steps per second overall and since the previous snapshot, the ETA, the
+    policy latency, the state of the work queue, the stats of each worker and the
+    slowest contexts. The snapshots are written by a timer thread, also while no
+    context completes, so `tail` can tell a stalled sweep.
+    """
+
+    def __init__(self, target, nb_contexts, interval=10, nb_slowest=5):
+        self.nb_contexts = nb_contexts
+        self.interval = interval
+        self.nb_slowest = nb_slowest
+        self.queue = None
+
+        self.start = self.last_emit = time.time()
+        self.nb_done = 0
+        self.nb_steps = 0
+        self.policy_seconds = 0.0
+        self.policy_calls = 0
+        self.workers = {}
+        self.slowest = []
+        # (time, done, steps) of the previous snapshots, for the recent throughput
+        self.history = deque([(self.start, 0, 0)], maxlen=6)
+        self.last_snapshot = None
+
+        self.file = self.socket = None
+        if target is not None and str(target).startswith("udp://"):
+            host, port = str(target).removeprefix("udp://").rsplit(":", 1)
+            self.address = (host, int(port))
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        elif target is not None:
+            Path(target).parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(target, "a", buffering=1)
+
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.timer = threading.Thread(target=self.run_timer, daemon=True)
+        self.timer.start()
+
+    def run_timer(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                if time.time() - self.last_emit >= self.interval:
+                    self.emit()
+
+    def record(self, index, data, elapsed=None, worker=None, policy_time=None):
+        """Record an evaluated context, the timings are those of `measure` if known."""
+        steps = count_steps(data)
+        with self.lock:
+            self.add(index, steps, elapsed, worker, policy_time)
+            if time.time() - self.last_emit >= self.interval:
+                self.emit()
+
+    def add(self, index, steps, elapsed, worker, policy_time):
+        self.nb_done += 1
+        self.nb_steps += steps
+
+        if policy_time is not None:
+            self.policy_seconds += policy_time[0]
+            self.policy_calls += policy_time[1]
+
+        if worker is not None:
+            stats = self.workers.setdefault(str(worker), dict(contexts=0, steps=0, busy_seconds=0.0))
+            stats["contexts"] += 1
+            stats["steps"] += int(steps)
+            stats["busy_seconds"] += elapsed or 0.0
+
+        if elapsed is not None:
+            heapq.heappush(self.slowest, (elapsed, index))
+            if len(self.slowest) > self.nb_slowest:
+                heapq.heappop(self.slowest)
+
+    def record_startup(self, worker, seconds, preloaded=False):
+        """Record the time a worker took to be ready, from the start of its pool."""
+        with self.lock:
+            stats = self.workers.setdefault(str(worker), dict(contexts=0, steps=0, busy_seconds=0.0))
+            stats["startup_seconds"] = seconds
+            stats["preloaded"] = preloaded
+
+    def follow(self, results):
+        """Record the `(index, data)` results as they are yielded."""
+        for index, data in results:
+            self.record(index, data)
+            yield index, data
+
+    def track(self, worker, contexts):
+        """Evaluate the contexts in this process like `map`, recording their timings."""
+        for context in contexts:
+            index, data, pid, elapsed, policy_time = measure(worker, context)
+            self.record(index, data, elapsed, pid, policy_time)
+            yield index, data
+
+    def snapshot(self):
+        now = time.time()
+        elapsed = now - self.start
+        then, done_then, steps_then = self.history[0]
+        window = now - then
+
+        recent_contexts_per_second = (self.nb_done - done_then) / window if window else 0
+        remaining = self.nb_contexts - self.nb_done
+
+        return dict(
+            time=now,
+            elapsed=elapsed,
+            done=self.nb_done,
+            total=self.nb_contexts,
+            steps_per_second=self.nb_steps / elapsed if elapsed else 0,
+            recent_steps_per_second=(self.nb_steps - steps_then) / window if window else 0,
+            eta_seconds=remaining / recent_contexts_per_second if recent_contexts_per_second else None,
+            policy_latency_ms=1e3 * self.policy_seconds / self.policy_calls if self.policy_calls else None,
+            queue=self.queue.counts() if self.queue is not None else None,
+            workers={
+                pid: dict(
+                    stats,
+                    utilization=stats["busy_seconds"] / elapsed if elapsed else 0,
+                    steps_per_second=stats["steps"] / stats["busy_seconds"] if stats["busy_seconds"] else 0,
+                )
+                for pid, stats in self.workers.items()
+            },
+            slowest=[[index, seconds] for seconds, index in sorted(self.slowest, reverse=True)],
+        )
+
+    def emit(self):
+        snapshot = self.snapshot()
+        self.history.append((snapshot["time"], self.nb_done, self.nb_steps))
+        self.last_emit = snapshot["time"]
+        self.last_snapshot = snapshot
+
+        line = json.dumps(snapshot, default=float)
+        if self.file is not None:
+            self.file.write(line + "\n")
+        elif self.socket is not None:
+            self.socket.sendto(line.encode(), self.address)
+
+        return snapshot
+
+    def summary(self):
+        """The last snapshot in a line, for a progress bar."""
+        return format_snapshot(self.last_snapshot) if self.last_snapshot is not None else ""
+
+    def close(self):
+        self.stopped.set()
+        self.timer.join()
+        with self.lock:
+            self.emit()
+        if self.file is not None:
+            self.file.close()
+        if self.socket is not None:
+            self.socket.close()
+
+
+## Following the snapshots
+
+def format_snapshot(snapshot):
+    eta = snapshot["eta_seconds"]
+    latency = snapshot["policy_latency_ms"]
+    workers = snapshot["workers"]
+    queue = snapshot["queue"]
+    utilization = np.mean([w["utilization"] for w in workers.values()]) if workers else None
+
+    parts = [
+        f"{snapshot['done']}/{snapshot['total']} contexts",
+        f"{snapshot['recent_steps_per_second']:.0f} steps/s",
+        f"ETA {eta / 3600:.2f} h" if eta is not None else "ETA ?",
+    ]
+    if latency is not None:
+        parts.append(f"policy {latency:.2f} ms")
+    if utilization is not None:
+        parts.append(f"{len(workers)} workers {utilization:.0%} busy")
+    if queue is not None:
+        parts.append(f"queue {queue['pending']} pending {queue['running']} running")
+    if snapshot["slowest"]:
+        index, seconds = snapshot["slowest"][0]
+        parts.append(f"slowest {index} ({seconds:.1f} s)")
+
+    return ", ".join(parts)
+
+
+def read_snapshots(target, poll=1):
+    """Yield the snapshots of a telemetry file as it grows, or received on "udp://host:port"."""
+    if str(target).startswith("udp://"):
+        host, port = str(target).removeprefix("udp://").rsplit(":", 1)
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.bind((host, int(port)))
+            while True:
+                yield json.loads(sock.recv(1 << 20))
+
+    with open(target) as file:
+        while True:
+            line = file.readline()
+            if line.endswith("\n"):
+                yield json.loads(line)
+            else:
+                # incomplete lines are read again once written
+                file.seek(file.tell() - len(line))
+                time.sleep(poll)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Follow the telemetry of a running sweep.")
+    parser.add_argument("command", choices=["tail"], help="'tail' prints the snapshots as they come")
+    parser.add_argument("target", help="the telemetry file, or udp://host:port to listen on")
+    parser.add_argument("--raw", action="store_true", help="print the JSON snapshots")
+    parser.add_argument("--stall", type=float, default=600, help="warn when no context completed for this many seconds")
+    args = parser.parse_args()
+
+    if not args.target.startswith("udp://") and not Path(args.target).exists():
+        print(f"error: '{args.target}' does not exist", file=sys.stderr)
+        exit(1)
+
+    last_done, last_progress = None, None
+    for snapshot in read_snapshots(args.target):
+        print(json.dumps(snapshot) if args.raw else format_snapshot(snapshot))
+
+        if snapshot["done"] != last_done:
+            last_done, last_progress = snapshot["done"], snapshot["time"]
+        elif snapshot["time"] - last_progress > args.stall:
+            print(f"warning: stalled, no context completed for {snapshot['time'] - last_progress:.0f} s", file=sys.stderr)
@@ -0,0 +1,449 @@
+import argparse
+from contextlib import contextmanager
+import hashlib
+import os
+from pathlib import Path
+import pickle
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from sweep import context_hash, load_worker
+from scheduler import limit_threads
+from preload import forkserver_context, preloaded_worker, reseed
+
+
+DEFAULT_LEASE = 600  # seconds a claimed context is kept by a worker without news from it
+DEFAULT_ATTEMPTS = 3  # claims of a context before it is marked failed
+
+
+## Queues
+
+class SQLiteQueue:
+    """Work queue in a SQLite database, which can live on a shared filesystem.
+
+    Each context is a task which is pending, running (claimed by a worker until its
+    lease expires), done (its result is stored in the database) or failed (its
+    evaluation raised or its lease expired on each of max_attempts claims).
+    """
+
+    def __init__(self, path, lease=DEFAULT_LEASE, max_attempts=DEFAULT_ATTEMPTS):
+        self.path = Path(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        # completion number of the last result taken by this coordinator
+        self.taken = 0
+
+        with self.connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value BLOB)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                position INTEGER PRIMARY KEY,
+                payload BLOB,
+                status TEXT DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER DEFAULT 0,
+                result BLOB,
+                error TEXT,
+                completed INTEGER
+            )""")
+            # queues created before the failures and the completion order were stored
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(tasks)")]
+            for column, kind in [("error", "TEXT"), ("completed", "INTEGER")]:
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE tasks ADD COLUMN {column} {kind}")
+            conn.execute("CREATE INDEX IF NOT EXISTS tasks_completed ON tasks (completed)")
+
+    @contextmanager
+    def connect(self):
+        # no WAL, it does not work on network filesystems
+        conn = sqlite3.connect(self.path, timeout=120, isolation_level=None)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def submit(self, job, contexts):
+        """Enqueue the contexts of a job, again after a restart, see `sweep_identity`."""
+        contexts = list(contexts)
+        identity = sweep_identity(job, contexts)
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            known = conn.execute("SELECT value FROM meta WHERE key = 'identity'").fetchone()
+            if known is not None and known[0] != identity:
+                conn.execute("ROLLBACK")
+                raise ValueError(f"the queue '{self.path}' holds another sweep, use a new one")
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('identity', ?)", (identity,))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('job', ?)", (pickle.dumps(job),))
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks (position, payload) VALUES (?, ?)",
+                ((position, pickle.dumps(context)) for position, context in enumerate(contexts)),
+            )
+            conn.execute("COMMIT")
+
+    def job(self):
+        with self.connect() as conn:
+            value, = conn.execute("SELECT value FROM meta WHERE key = 'job'").fetchone()
+        return pickle.loads(value)
+
+    def claim(self, worker):
+        """Claim a pending task, or one whose lease expired, returns (position, context) or None."""
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            # the worker died on each claim, e.g. killed for its memory
+            conn.execute(
+                """UPDATE tasks SET status = 'failed', error = COALESCE(error, 'the lease expired on each attempt')
+                WHERE status = 'running' AND lease_until < ? AND attempts >= ?""",
+                (now, self.max_attempts),
+            )
+            row = conn.execute(
+                """SELECT position, payload FROM tasks
+                WHERE status = 'pending' OR (status = 'running' AND lease_until < ?)
+                ORDER BY position LIMIT 1""",
+                (now,),
+            ).fetchone()
+
+            if row is not None:
+                conn.execute(
+                    "UPDATE tasks SET status = 'running', worker = ?, lease_until = ?, attempts = attempts + 1 WHERE position = ?",
+                    (worker, now + self.lease, row[0]),
+                )
+            conn.execute("COMMIT")
+
+        if row is None:
+            return None
+
+        position, payload = row
+        return position, pickle.loads(payload)
+
+    def renew(self, position, worker):
+        with self.connect() as conn:
+            conn.execute(
+                "UPDATE tasks SET lease_until = ? WHERE position = ? AND worker = ? AND status = 'running'",
+                (time.time() + self.lease, position, worker),
+            )
+
+    def complete(self, position, worker, result):
+        # the first result wins if the lease expired and the task was re-issued meanwhile
+        with self.connect() as conn:
+            conn.execute(
+                """UPDATE tasks SET status = 'done', worker = ?, result = ?,
+                completed = (SELECT COALESCE(MAX(completed), 0) + 1 FROM tasks)
+                WHERE position = ? AND status != 'done'""",
+                (worker, pickle.dumps(result), position),
+            )
+
+    def fail(self, position, worker, error):
+        """Give a task back after its evaluation raised, it fails once it was claimed max_attempts times."""
+        with self.connect() as conn:
+            conn.execute(
+                """UPDATE tasks SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ?
+                WHERE position = ? AND worker = ? AND status = 'running'""",
+                (self.max_attempts, error, position, worker),
+            )
+
+    def counts(self):
+        counts = dict(pending=0, running=0, done=0, failed=0)
+        with self.connect() as conn:
+            counts.update(conn.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall())
+        return counts
+
+    def failures(self):
+        """Position and last error of each failed task."""
+        with self.connect() as conn:
+            return conn.execute("SELECT position, error FROM tasks WHERE status = 'failed' ORDER BY position").fetchall()
+
+    def take_results(self):
+        """Results completed since the last call, as (position, result)."""
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT completed, position, result FROM tasks WHERE completed > ? ORDER BY completed", (self.taken,)
+            ).fetchall()
+
+        for completed, position, result in rows:
+            self.taken = completed
+            yield position, pickle.loads(result)
+
+
+class DirectoryQueue:
+    """Work queue as a directory of files, which can live on a shared filesystem.
+
+    Tasks move from pending/ to running/ to done/ with atomic renames, so a task is
+    claimed by a single worker. The lease of a running task is the modification time
+    of its file. Each claim appends a byte to the task's file in attempts/, a task
+    claimed max_attempts times goes to failed/ with its last error instead of back
+    to pending/. The results taken by the coordinator are moved to taken/.
+    """
+
+    def __init__(self, path, lease=DEFAULT_LEASE, max_attempts=DEFAULT_ATTEMPTS):
+        self.path = Path(path)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.recovered = False
+
+        for state in ("pending", "running", "done", "taken", "failed", "attempts"):
+            (self.path / state).mkdir(parents=True, exist_ok=True)
+
+    def task_file(self, state, position):
+        return self.path / state / f"{position:08d}.pkl"
+
+    def attempts(self, position):
+        try:
+            return (self.path / "attempts" / f"{position:08d}").stat().st_size
+        except FileNotFoundError:
+            return 0
+
+    def give_back(self, file, error):
+        """Move a running task back to pending/, or to failed/ with its error after max_attempts claims."""
+        position = int(file.stem)
+        if self.attempts(position) < self.max_attempts:
+            os.rename(file, self.task_file("pending", position))
+        else:
+            write_atomic(self.path / "failed" / f"{position:08d}.txt", error.encode())
+            os.rename(file, self.task_file("failed", position))
+
+    def submit(self, job, contexts):
+        """Enqueue the contexts of a job, again after a restart, see `sweep_identity`."""
+        contexts = list(contexts)
+        identity = sweep_identity(job, contexts)
+        try:
+            if (self.path / "identity").read_text() != identity:
+                raise ValueError(f"the queue '{self.path}' holds another sweep, use a new one")
+        except FileNotFoundError:
+            write_atomic(self.path / "identity", identity.encode())
+
+        write_atomic(self.path / "job.pkl", pickle.dumps(job))
+
+        for position, context in enumerate(contexts):
+            if not any(self.task_file(state, position).exists() for state in ("pending", "running", "done", "taken", "failed")):
+                write_atomic(self.task_file("pending", position), pickle.dumps(context))
+
+    def job(self):
+        return pickle.loads((self.path / "job.pkl").read_bytes())
+
+    def requeue_stale(self):
+        now = time.time()
+        for file in (self.path / "running").glob("*.pkl"):
+            try:
+                if file.stat().st_mtime + self.lease < now:
+                    self.give_back(file, "the lease expired on each attempt")
+            except FileNotFoundError:
+                pass  # completed or re-issued by someone else
+
+    def claim(self, worker):
+        self.requeue_stale()
+
+        for file in sorted((self.path / "pending").glob("*.pkl")):
+            running = self.path / "running" / file.name
+            try:
+                # touched first so the lease starts fresh once running
+                os.utime(file)
+                os.rename(file, running)
+            except FileNotFoundError:
+                continue  # claimed by someone else
+
+            with open(self.path / "attempts" / file.stem, "ab") as attempts:
+                attempts.write(b".")
+            return int(file.stem), pickle.loads(running.read_bytes())
+
+        return None
+
+    def renew(self, position, worker):
+        try:
+            os.utime(self.task_file("running", position))
+        except FileNotFoundError:
+            pass
+
+    def complete(self, position, worker, result):
+        # the first result wins if the lease expired and the task was re-issued meanwhile
+        if not self.task_file("taken", position).exists():
+            write_atomic(self.task_file("done", position), pickle.dumps(result))
+        self.task_file("running", position).unlink(missing_ok=True)
+        self.task_file("pending", position).unlink(missing_ok=True)
+        self.task_file("failed", position).unlink(missing_ok=True)
+
+    def fail(self, position, worker, error):
+        """Give a task back after its evaluation raised, it fails once it was claimed max_attempts times."""
+        try:
+            self.give_back(self.task_file("running", position), error)
+        except FileNotFoundError:
+            pass  # completed or re-issued by someone else
+
+    def counts(self):
+        counts = {state: len(list((self.path / state).glob("*.pkl"))) for state in ("pending", "running", "done", "failed")}
+        counts["done"] += len(list((self.path / "taken").glob("*.pkl")))
+        return counts
+
+    def failures(self):
+        """Position and last error of each failed task."""
+        return [
+            (int(file.stem), (self.path / "failed" / f"{file.stem}.txt").read_text())
+            for file in sorted((self.path / "failed").glob("*.pkl"))
+        ]
+
+    def take_results(self):
+        """Results completed since the last call, as (position, result).
+
+        The first call also returns those a previous coordinator took, so a
+        restarted sweep gets all of them.
+        """
+        states = ("done",) if self.recovered else ("taken", "done")
+        self.recovered = True
+
+        for state in states:
+            for file in sorted((self.path / state).glob("*.pkl")):
+                position = int(file.stem)
+                result = pickle.loads(file.read_bytes())
+                if state == "done":
+                    os.replace(file, self.task_file("taken", position))
+                yield position, result
+
+
+def sweep_identity(job, contexts):
+    """Hash of the job identity and of the contexts in their order.
+
+    The tasks are kept by position, so a queue only takes the contexts of the sweep
+    it was created for, e.g. when a generator is restarted.
+    """
+    # result_cache imports this module
+    from result_cache import job_key
+
+    digest = hashlib.sha1(job_key(job).encode())
+    for context in contexts:
+        digest.update(context_hash(context).encode())
+    return digest.hexdigest()
+
+
+def write_atomic(path, data):
+    tmp = path.with_name(f".{path.name}.{socket.gethostname()}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def open_queue(path, lease=DEFAULT_LEASE, max_attempts=DEFAULT_ATTEMPTS):
+    """A SQLite queue for '.sqlite' or '.db' paths, a directory queue otherwise."""
+    if Path(path).suffix in (".sqlite", ".db"):
+        return SQLiteQueue(path, lease, max_attempts)
+    return DirectoryQueue(path, lease, max_attempts)
+
+
+## Coordinator and workers
+
+def wait_results(queue, nb_tasks, poll=5):
+    """Yield the results of the queue as the workers complete them, until all are done or failed.
+
+    The failed tasks are reported on stderr, the sweep goes on without them.
+    """
+    seen = set()
+
+    while len(seen) < nb_tasks:
+        new = False
+        for position, result in queue.take_results():
+            # a re-issued task may complete twice
+            if position not in seen:
+                seen.add(position)
+                new = True
+                yield result
+
+        if not new:
+            failures = [(position, error) for position, error in queue.failures() if position not in seen]
+            if len(seen) + len(failures) >= nb_tasks:
+                for position, error in failures:
+                    print(f"warning: context {position} failed after {queue.max_attempts} attempts: {error}", file=sys.stderr)
+                break
+            time.sleep(poll)
+
+
+def work(queue, worker_id=None, poll=5, wait=False):
+    """Evaluate the contexts of the queue until there is none left to claim.
+
+    With wait, keep polling for new contexts instead of stopping.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    job = queue.job()
+    evaluate = preloaded_worker(job) or load_worker(job)
+    nb_done = 0
+
+    while True:
+        task = queue.claim(worker_id)
+
+        if task is None:
+            counts = queue.counts()
+            if not wait and counts["pending"] == counts["running"] == 0:
+                break
+            # running tasks may still be re-issued if their worker died
+            time.sleep(poll)
+            continue
+
+        position, context = task
+
+        stop = threading.Event()
+        renewer = threading.Thread(target=renew_lease, args=(queue, position, worker_id, stop), daemon=True)
+        renewer.start()
+        try:
+            result = evaluate(context)
+        except Exception as error:
+            # another claim may succeed, e.g. on a node with more memory
+            queue.fail(position, worker_id, f"{type(error).__name__}: {error}")
+            continue
+        finally:
+            stop.set()
+            renewer.join()
+
+        queue.complete(position, worker_id, result)
+        nb_done += 1
+
+    return nb_done
+
+
+def renew_lease(queue, position, worker_id, stop):
+    while not stop.wait(queue.lease / 3):
+        queue.renew(position, worker_id)
+
+
+def _work_process(path, lease, max_attempts, poll):
+    reseed()
+    work(open_queue(path, lease, max_attempts), poll=poll)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Evaluate the contexts of a sweep distributed through a work queue.")
+    parser.add_argument("command", choices=["work", "status"], help="'work' evaluates contexts, 'status' shows the state of the queue")
+    parser.add_argument("queue", type=Path, help="the queue, a '.sqlite' or '.db' file or a directory")
+    parser.add_argument("-p", "--processes", type=int, default=1, help="number of worker processes to start on this node")
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE, help="seconds after which a silent worker's context is re-issued")
+    parser.add_argument("--attempts", type=int, default=DEFAULT_ATTEMPTS, help="claims of a context before it is marked failed")
+    parser.add_argument("--poll", type=float, default=5, help="seconds between polls of the queue")
+    parser.add_argument("--threads", type=int, default=1, help="torch and BLAS threads per worker process")
+    args = parser.parse_args()
+
+    if not args.queue.exists():
+        print(f"error: '{args.queue}' is not a queue", file=sys.stderr)
+        exit(1)
+
+    # before the workers load torch, to avoid oversubscribing the cores
+    limit_threads(args.threads)
+
+    if args.command == "status":
+        print(open_queue(args.queue, args.lease, args.attempts).counts())
+
+    elif args.processes == 1:
+        nb_done = work(open_queue(args.queue, args.lease, args.attempts), poll=args.poll)
+        print(f"done, evaluated {nb_done} contexts.")
+
+    else:
+        # forked from a server which loaded the policy once
+        ctx = forkserver_context(open_queue(args.queue, args.lease, args.attempts).job())
+        processes = [
+            ctx.Process(target=_work_process, args=(args.queue, args.lease, args.attempts, args.poll))
+            for _ in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        print("done.")